@@ -41,6 +41,10 @@
 
 __version__ = 3.0
 
+from .access_log import AccessLog
 from .file_handler import FileHandler
 from .core import RequestHandler, RequestProcessor, listen
+from .cache import CachedRequestProcessor, ResponseCache, cached
+from .broadcast import BroadcastHub
+from .proxy import ReverseProxy
 from . import writer
@@ -0,0 +1,103 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Access log """
+
+import logging
+import threading
+import time
+
+class AccessLog(object):
+    """
+     Access log written by a background thread.
+
+     An entry is recorded when the last byte of the response has been
+     sent, so pipelined requests are logged in order with their own
+     status and size, and the duration covers the whole response. The
+     status is "-" for requests whose connection closed first.
+
+     The event loop thread stores each entry in a preallocated ring
+     buffer, which is cheap and never blocks on disk I/O. A background
+     thread formats and writes the entries in batches every interval
+     seconds. When the backlog exceeds sample_threshold entries, only
+     one entry every sample_rate is recorded; when the ring is full,
+     entries are dropped and counted.
+    """
+
+    def __init__(self, filep, size=8192, interval=0.5,
+                 sample_threshold=4096, sample_rate=10):
+        if size & (size - 1):
+            raise ValueError("size must be a power of two")
+        self._dropped = 0
+        self._filep = filep
+        self._head = 0
+        self._interval = interval
+        self._mask = size - 1
+        self._ring = [None] * size
+        self._sample_rate = sample_rate
+        self._sample_threshold = sample_threshold
+        self._sampled = 0
+        self._stop = threading.Event()
+        self._tail = 0
+        self._thread = threading.Thread(target=self._run,
+                                         name="neubot-http-access-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, method, url, status, nbytes, duration):
+        """ Record a completed request (called by the event loop thread) """
+        backlog = self._head - self._tail
+        if backlog > self._mask:
+            self._dropped += 1
+            return
+        if backlog >= self._sample_threshold:
+            self._sampled += 1
+            if self._sampled % self._sample_rate:
+                return
+        self._ring[self._head & self._mask] = (time.time(), method, url,
+                                               status, nbytes, duration)
+        self._head += 1
+
+    @staticmethod
+    def _format(entry):
+        """ Format an entry """
+        when, method, url, status, nbytes, duration = entry
+        return '[%s] "%s %s" %s %d %.6f\n' % (
+            time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(when)),
+            method, url, status or "-", nbytes, duration)
+
+    def _flush(self):
+        """ Write the entries recorded so far """
+        head, tail = self._head, self._tail
+        if head == tail:
+            return
+        lines = []
+        while tail < head:
+            lines.append(self._format(self._ring[tail & self._mask]))
+            tail += 1
+        self._tail = tail
+        try:
+            self._filep.write("".join(lines))
+            self._filep.flush()
+        except (OSError, IOError):
+            logging.warning("access_log: cannot write", exc_info=True)
+
+    def _run(self):
+        """ Background thread main loop """
+        while not self._stop.wait(self._interval):
+            self._flush()
+        self._flush()
+
+    @property
+    def dropped(self):
+        """ Get number of entries dropped because the ring was full """
+        return self._dropped
+
+    def close(self):
+        """ Write pending entries and stop the background thread """
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,111 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Broadcast to long-poll / server-sent-events subscribers """
+
+import logging
+import time
+
+from .core import RequestHandler
+from . import writer
+
+def _frame(data):
+    """ Frame data as a chunk, once, as immutable bytes """
+    return memoryview(b"%x\r\n%s\r\n" % (len(data), data))
+
+class _SubscribeHandler(RequestHandler):
+    """ Handler that subscribes the connection to a hub """
+
+    def __init__(self, hub):
+        self._hub = hub
+
+    def on_end(self, connection, _):
+        self._hub.subscribe(connection)
+
+class BroadcastHub(object):
+    """
+     Sends the same stream of events to many subscribers.
+
+     Each published event is encoded and chunk-framed once, and the same
+     memoryview is appended to the output queue of every subscriber. A
+     subscriber whose queue holds more than max_queue elements is slow:
+     it is closed when drop_slow is True, otherwise it skips events until
+     it catches up. Call periodic() from the application loop to send the
+     heartbeat to subscribers idle for heartbeat_interval seconds.
+
+     An instance is also a route handler factory: requests routed to it
+     are subscribed to the hub.
+    """
+
+    def __init__(self, headers=None, max_queue=64, drop_slow=True,
+                 heartbeat=b":\n\n", heartbeat_interval=15.0,
+                 encoding="utf-8"):
+        if headers is None:
+            headers = {
+                "Cache-Control": "no-cache",
+                "Content-Type": "text/event-stream",
+            }
+        headers = dict(headers)
+        headers["Transfer-Encoding"] = "chunked"
+        self._headers = headers
+        self._max_queue = max_queue
+        self._drop_slow = drop_slow
+        self._heartbeat = _frame(heartbeat)
+        self._heartbeat_interval = heartbeat_interval
+        self._encoding = encoding
+        self._subscribers = {}
+
+    def __call__(self):
+        return _SubscribeHandler(self)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, connection):
+        """ Send the response headers and subscribe connection """
+        # The response never ends, so it must not count as in flight
+        connection.detach_inflight()
+        connection.write(writer.compose_headers("200", "Ok",
+                                                dict(self._headers)))
+        self._subscribers[connection] = time.monotonic()
+
+    def unsubscribe(self, connection):
+        """ Unsubscribe connection """
+        self._subscribers.pop(connection, None)
+
+    def _send(self, frame, now, idle_since):
+        """ Send frame to subscribers idle since idle_since """
+        for connection, last_sent in list(self._subscribers.items()):
+            if not connection.connected:
+                del self._subscribers[connection]
+                continue
+            if last_sent > idle_since:
+                continue
+            if connection.queue_depth >= self._max_queue:
+                if self._drop_slow:
+                    logging.debug("broadcast: dropping slow subscriber")
+                    del self._subscribers[connection]
+                    connection.close()
+                continue
+            connection.write(frame)
+            self._subscribers[connection] = now
+
+    def publish(self, data):
+        """ Send data to all subscribers """
+        if not data:
+            return  # The empty chunk would terminate the streams
+        if isinstance(data, str):
+            data = data.encode(self._encoding)
+        elif not isinstance(data, bytes):
+            data = bytes(data)  # bytearray, memoryview, etc.
+        now = time.monotonic()
+        self._send(_frame(data), now, now)
+
+    def periodic(self):
+        """ Send heartbeat to idle subscribers and forget closed ones """
+        now = time.monotonic()
+        self._send(self._heartbeat, now, now - self._heartbeat_interval)
@@ -0,0 +1,263 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Response cache """
+
+import collections
+import logging
+import time
+
+from .core import RequestProcessor
+from .outqueue import OutputQueue
+from .parser import Error, Parser
+
+def _parse_cache_control(value):
+    """ Parse Cache-Control header value into a dictionary """
+    directives = {}
+    for token in value.lower().split(","):
+        token = token.strip()
+        if not token:
+            continue
+        name, _, argument = token.partition("=")
+        directives[name.strip()] = argument.strip().strip('"')
+    return directives
+
+class ResponseCache(object):
+    """ LRU cache of serialized responses with a global byte budget """
+
+    def __init__(self, max_bytes=16777216):
+        self._entries = collections.OrderedDict()
+        self._max_bytes = max_bytes
+        self._pending = {}
+        self._total = 0
+
+    def get(self, key):
+        """ Return the cached response bytes for key or None """
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, data, ttl):
+        """ Store the response bytes for key for ttl seconds """
+        if ttl <= 0 or len(data) > self._max_bytes:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, data)
+        self._total += len(data)
+        while self._total > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """ Remove key from cache, if present """
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._total -= len(entry[1])
+
+    @property
+    def max_bytes(self):
+        """ Get the byte budget """
+        return self._max_bytes
+
+    def begin(self, key):
+        """ Returns the pending record if caller shall fill key, else None """
+        if key in self._pending:
+            return None
+        record = (time.monotonic(), [])
+        self._pending[key] = record
+        return record
+
+    def pending(self, key):
+        """ Returns the pending record for key or None """
+        return self._pending.get(key)
+
+    def wait(self, key, waiter):
+        """ Wait for the pending response for key """
+        self._pending[key][1].append(waiter)
+
+    def end(self, key, record):
+        """ Return the waiters for key, if record is still pending """
+        if self._pending.get(key) is not record:
+            return []
+        del self._pending[key]
+        return record[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+_DEFAULT_CACHE = ResponseCache()
+
+class _CapturingConnection(object):
+    """ Connection wrapper that records the response as it is sent """
+
+    def __init__(self, processor, key, record, connection):
+        self._connection = connection
+        self._count = 0
+        self._key = key
+        self._max_bytes = processor.max_bytes
+        self._parser = Parser()
+        self._pieces = []
+        self._processor = processor
+        self._record = record
+        connection.add_close_callback(self._on_close)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def write(self, data):
+        """ Forward data, recording it lazily while it is sent """
+        if self._parser is None:
+            self._connection.write(data)
+            return
+        self._connection.write(self._capture(data))
+
+    def _capture(self, data):
+        """ Generator that records data while it is sent """
+        queue = OutputQueue()
+        queue.insert_data(data)
+        chunk = queue.get_next_chunk()
+        while chunk is not None:
+            if self._parser is not None:
+                self._feed(chunk.tobytes())
+            yield chunk
+            chunk = queue.get_next_chunk()
+
+    def _stop(self, response):
+        """ Stop recording and complete the pending record """
+        self._parser = None
+        self._connection.remove_close_callback(self._on_close)
+        data = None
+        if response:
+            data = b"".join(self._pieces)
+        self._pieces = None
+        # pylint: disable = protected-access
+        self._processor._complete(self._key, self._record, response, data)
+
+    def _feed(self, data):
+        """ Record data and check whether the response is complete """
+        self._count += len(data)
+        if self._count > self._max_bytes:
+            logging.debug("cache: response for %s is too large",
+                          self._key[1])
+            self._stop(None)
+            return
+        self._pieces.append(data)
+        self._parser.feed(data)
+        try:
+            result = self._parser.parse()
+            while result:
+                if result[0] == "end":
+                    self._stop(result[1])
+                    return
+                result = self._parser.parse()
+        except Error:
+            logging.warning("cache: cannot parse response for %s",
+                            self._key[1])
+            self._stop(None)
+
+    def _on_close(self):
+        """ Called when connection is closed before the end of response """
+        if self._parser is not None:
+            logging.debug("cache: connection closed while filling %s",
+                          self._key[1])
+            self._stop(None)
+
+class CachedRequestProcessor(RequestProcessor):
+    """ Request processor that caches responses """
+
+    def __init__(self, callback, ttl, vary=(), cache=None, fill_timeout=30.0):
+        RequestProcessor.__init__(self, callback)
+        self._fill_timeout = fill_timeout
+        self._ttl = ttl
+        self._vary = tuple(name.lower() for name in vary)
+        if cache is None:
+            cache = _DEFAULT_CACHE
+        self._cache = cache
+
+    @property
+    def max_bytes(self):
+        """ Get the size of the largest response that can be cached """
+        return self._cache.max_bytes
+
+    def _make_key(self, request):
+        """ Make the cache key of request """
+        path, _, query = request.url.partition("?")
+        return (request.method, path, query) + tuple(
+            request[name] for name in self._vary)
+
+    def on_end(self, connection, request):
+        if request.method != "GET":
+            self._callback(connection, request)
+            return
+        directives = _parse_cache_control(request["cache-control"])
+        if "no-cache" in directives or "no-store" in directives:
+            self._callback(connection, request)
+            return
+
+        key = self._make_key(request)
+        data = self._cache.get(key)
+        if data is not None:
+            logging.debug("cache: hit for %s", request.url)
+            connection.write(data)
+            return
+        record = self._cache.pending(key)
+        if record and time.monotonic() - record[0] > self._fill_timeout:
+            logging.warning("cache: giving up waiting for %s", request.url)
+            self._complete(key, record, None, None)
+        record = self._cache.begin(key)
+        if not record:
+            logging.debug("cache: waiting for %s", request.url)
+            # Keep pipelined requests from being answered before this one
+            connection.pause_reading()
+            self._cache.wait(key, (connection, request))
+            return
+
+        logging.debug("cache: miss for %s", request.url)
+        try:
+            self._callback(_CapturingConnection(self, key, record,
+                                                connection), request)
+        except Exception:
+            self._complete(key, record, None, None)
+            raise
+
+    def _complete(self, key, record, response, data):
+        """ Store the response and release the waiting connections """
+        waiters = self._cache.end(key, record)
+        if response is None:
+            # Cannot share the response: process each request on its own
+            for connection, request in waiters:
+                self._callback(connection, request)
+                connection.resume_reading()
+            return
+        for connection, _ in waiters:
+            connection.write(data)
+            connection.resume_reading()
+        if response.code != "200":
+            return
+        directives = _parse_cache_control(response["cache-control"])
+        if ("no-store" in directives or "no-cache" in directives or
+                "private" in directives):
+            return
+        ttl = self._ttl
+        if "max-age" in directives:
+            try:
+                ttl = min(ttl, int(directives["max-age"]))
+            except ValueError:
+                pass
+        self._cache.put(key, data, ttl)
+
+def cached(ttl, vary=(), cache=None, fill_timeout=30.0):
+    """ Decorator to reply using a simple function and cache the response """
+    def decorator(callback):
+        """ Wrap callback into a CachedRequestProcessor """
+        return CachedRequestProcessor(callback, ttl, vary, cache,
+                                      fill_timeout)
+    return decorator
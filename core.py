@@ -8,14 +8,47 @@
 """ Core API of this module """
 
 import asyncore
+import errno
 import logging
 import socket
+import time
 
 from .outqueue import OutputQueue
 from .parser import Parser
+from .tracker import ResponseTracker
 
 from . import writer
 
+_BUFFERS = {}
+
+def _get_buffer(size):
+    """ Get the shared receive buffer of the given size """
+    #
+    # Buffers are shared by all connections, because handle_read() detaches
+    # the parser from them before the next recv_into() on the loop thread
+    # overwrites their content. Sizes are powers of two, so there are only
+    # a few of them, and idle connections do not keep any buffer around.
+    #
+    if size not in _BUFFERS:
+        _BUFFERS[size] = memoryview(bytearray(size))
+    return _BUFFERS[size]
+
+def _setsockopt(sock, level, name, value):
+    """
+     Set socket option by name, if supported by this platform. Returns
+     the resolved (level, option, value) tuple on success, None otherwise.
+    """
+    option = getattr(socket, name, None)
+    if option is None:
+        logging.warning("http: %s is not supported", name)
+        return None
+    try:
+        sock.setsockopt(level, option, value)
+    except (OSError, socket.error) as error:
+        logging.warning("http: cannot set %s: %s", name, error)
+        return None
+    return level, option, value
+
 class RequestHandler(object):
     """ HTTP request handler """
 
@@ -57,6 +90,15 @@ class NotFoundHandler(RequestHandler):
     def on_end(self, connection, _):
         connection.write(writer.compose_response_error("404", "Not Found"))
 
+class ServiceUnavailableHandler(RequestHandler):
+    """ '503 Service Unavailable' handler used to shed load """
+
+    def __init__(self, response):
+        self._response = response
+
+    def on_end(self, connection, _):
+        connection.write(self._response)
+
 class RequestDispatcher(asyncore.dispatcher):
     """ HTTP request dispatcher """
 
@@ -66,23 +108,91 @@ class RequestDispatcher(asyncore.dispatcher):
         self._parser = Parser()
         self._queue = OutputQueue()
         self._server = server
+        self._tracker = ResponseTracker(self._response_done)
+        self._closed = False
+        self._close_callbacks = []
+        self._entry = None
+        self._paused = False
+        self._server.connection_made()
+        self._read_budget = 262144
+        self._read_size = 4096
+        self._read_size_max = 262144
+        self._read_size_min = 4096
+
+    def _recv_into(self, view):
+        """ Like recv() but uses recv_into(); returns -1 on EAGAIN """
+        try:
+            count = self.socket.recv_into(view)
+        except OSError as why:
+            if why.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return -1
+            if why.errno in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+        if not count:
+            self.handle_close()
+        return count
+
+    def _adapt_read_size(self, count):
+        """ Grow read size for bulk transfers, shrink it for small ones """
+        if count >= self._read_size and self._read_size < self._read_size_max:
+            self._read_size <<= 1
+        elif (count < self._read_size >> 2 and
+              self._read_size > self._read_size_min):
+            self._read_size >>= 1
 
     def handle_read(self):
-        data = self.recv(65535)
-        logging.debug("http: received %d bytes", len(data))
-        if data:
-            self._parser.feed(data)
-        else:
-            self._parser.eof()
-        result = self._parser.parse()
-        while result:
-            self._emit(result)
+        self._server.note_activity()
+        budget = self._read_budget
+        while budget > 0:
+            view = _get_buffer(self._read_size)
+            count = self._recv_into(view)
+            if count < 0:
+                break
+            logging.debug("http: received %d bytes", count)
+            if count:
+                self._parser.feed(view[:count])
+            else:
+                self._parser.eof()
+            self._process()
+            self._parser.detach()  # The buffer will be reused
+            if not count or not self.connected or self._paused:
+                break
+            budget -= count
+            filled = count == len(view)
+            self._adapt_read_size(count)
+            if not filled:
+                break  # Socket buffer is most likely empty now
+
+    def _process(self):
+        """ Emit the events for buffered data, unless paused """
+        while not self._paused:
             result = self._parser.parse()
+            if not result:
+                break
+            self._emit(result)
+
+    def pause_reading(self):
+        """ Stop reading and processing incoming data """
+        self._paused = True
+
+    def resume_reading(self):
+        """ Process buffered data and resume reading """
+        if self._paused:
+            self._paused = False
+            self._process()
+
+    def readable(self):
+        return not self._paused
 
     def _emit(self, event):
         """ Emit the specified event """
         if event[0] == "request":
             self._handler = self._server.route(event[1])
+            self._entry = [event[1], time.monotonic(), True]
+            self._tracker.expect(event[1], self._entry)
+            self._server.request_started()
             self._handler.on_request(self, event[1])
         elif event[0] == "data":
             self._handler.on_data(self, event[1], event[2])
@@ -91,32 +201,190 @@ class RequestDispatcher(asyncore.dispatcher):
         else:
             raise RuntimeError
 
+    def detach_inflight(self):
+        """
+         Stop counting the current request as in flight. Handlers that
+         stream long-lived responses call this, so that the response
+         does not hold an in-flight slot until the connection closes.
+        """
+        if self._entry and self._entry[2]:
+            self._entry[2] = False
+            self._server.request_done()
+
+    def _response_done(self, entry, status, count):
+        """ Called when the response to a request has been sent """
+        request, started, inflight = entry
+        access_log = self._server.access_log
+        if access_log:
+            access_log.record(request.method, request.url, status, count,
+                              time.monotonic() - started)
+        if inflight:
+            self._server.request_done()
+
     def write(self, data):
         """ Write bytes, str or generator to socket """
         self._queue.insert_data(data)
 
+    @property
+    def queue_depth(self):
+        """ Get the number of elements waiting to be sent """
+        return len(self._queue)
+
     def writable(self):
         return bool(self._queue)
 
     def handle_write(self):
+        self._server.note_activity()
         chunk = self._queue.get_next_chunk()
         if chunk:
-            chunk = chunk[self.send(chunk):]
+            count = self.send(chunk)
+            if count:
+                self._tracker.feed(chunk[:count])
+            chunk = chunk[count:]
             if chunk:
-                self.reinsert_partial_chunk(chunk)
+                self._queue.reinsert_partial_chunk(chunk)
+
+    def add_close_callback(self, callback):
+        """ Call callback() when this connection is closed """
+        self._close_callbacks.append(callback)
+
+    def remove_close_callback(self, callback):
+        """ Remove callback previously added with add_close_callback() """
+        if callback in self._close_callbacks:
+            self._close_callbacks.remove(callback)
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        if self._closed:
+            return
+        self._closed = True
+        callbacks, self._close_callbacks = self._close_callbacks, []
+        for callback in callbacks:
+            callback()
+        self._tracker.close()
+        self._server.connection_lost()
 
 class Server(asyncore.dispatcher):
     """ HTTP server """
 
-    def __init__(self, file_handler=None, factory=RequestDispatcher):
+    def __init__(self, file_handler=None, factory=RequestDispatcher,
+                 max_connections=0, max_inflight=0, max_loop_lag=0.0,
+                 retry_after=1, accept_budget=64, access_log=None):
         asyncore.dispatcher.__init__(self)
+        self._accept_budget = accept_budget
+        self._access_log = access_log
         self._factory = factory
+        self._sockopts = []
+        self._sockopts_checked = False
         self._file_handler = file_handler
         self._routes = {}
-
-    def add_route(self, url, handler):
-        """ Add a route """
+        self._priorities = {}
+        self._connections = 0
+        self._inflight = 0
+        self._max_connections = max_connections
+        self._max_inflight = max_inflight
+        self._max_loop_lag = max_loop_lag
+        self._loop_lag = 0.0
+        self._busy_since = None
+        self._unavailable = "".join(writer.compose_response(
+            "503", "Service Unavailable", {
+                "Content-Type": "text/plain",
+                "Retry-After": retry_after,
+            }, "Service Unavailable\n")).encode("iso-8859-1")
+
+    def add_sockopt(self, level, option, value):
+        """ Set socket option on each accepted socket """
+        self._sockopts.append((level, option, value))
+        self._sockopts_checked = False
+
+    def _check_sockopts(self, sock):
+        """ Forget the options that sock inherited from the listener """
+        #
+        # Linux copies options such as TCP_NODELAY and TCP_NOTSENT_LOWAT
+        # from the listening socket, other systems may not. We look at the
+        # first accepted socket, so we make the syscalls only when needed.
+        #
+        sockopts = []
+        for level, option, value in self._sockopts:
+            try:
+                if sock.getsockopt(level, option) == value:
+                    continue
+            except (OSError, socket.error):
+                pass
+            sockopts.append((level, option, value))
+        self._sockopts = sockopts
+        self._sockopts_checked = True
+
+    def add_route(self, url, handler, priority=0):
+        """
+         Add a route.
+
+         Routes with positive priority are never shed under overload,
+         which is useful for health checks and measurements.
+        """
         self._routes[url] = handler
+        self._priorities[url] = priority
+
+    @property
+    def access_log(self):
+        """ Get the access log, or None """
+        return self._access_log
+
+    @property
+    def inflight(self):
+        """ Get number of requests whose response is not completely sent """
+        return self._inflight
+
+    @property
+    def loop_lag(self):
+        """ Get smoothed time spent processing an event loop iteration """
+        return self._loop_lag
+
+    def note_activity(self):
+        """ Called by connections when they start doing I/O """
+        if self._busy_since is None:
+            self._busy_since = time.monotonic()
+
+    def request_started(self):
+        """ Called by connections when they receive a request """
+        self._inflight += 1
+
+    def request_done(self):
+        """ Called by connections when they have sent a response """
+        self._inflight -= 1
+
+    def connection_made(self):
+        """ Called by connections when they are created """
+        self._connections += 1
+
+    def connection_lost(self):
+        """ Called by connections when they are closed """
+        self._connections -= 1
+
+    def _overloaded(self):
+        """ Returns True if we should shed load """
+        if self._max_inflight and self._inflight >= self._max_inflight:
+            return True
+        if self._max_loop_lag and self._loop_lag > self._max_loop_lag:
+            return True
+        return False
+
+    def readable(self):
+        #
+        # Called once per loop iteration before select(), so this is the
+        # place where we measure how long the previous iteration spent
+        # processing I/O events. When we refuse to accept, clients wait
+        # in the kernel backlog.
+        #
+        if self._busy_since is not None:
+            sample = time.monotonic() - self._busy_since
+            self._busy_since = None
+        else:
+            sample = 0.0
+        self._loop_lag = 0.8 * self._loop_lag + 0.2 * sample
+        if self._max_connections:
+            return self._connections < self._max_connections
+        return True
 
     def route(self, request):
         """ Route request """
@@ -128,6 +396,10 @@ class Server(asyncore.dispatcher):
             url = url[:index]
             logging.debug("http: router url without query: %s", url)
 
+        if self._overloaded() and self._priorities.get(url, 0) <= 0:
+            logging.debug("http: overloaded; shedding request for %s", url)
+            return ServiceUnavailableHandler(self._unavailable)
+
         if url in self._routes:
             return self._routes[url]()
         if self._file_handler:
@@ -135,11 +407,29 @@ class Server(asyncore.dispatcher):
         return NotFoundHandler()
 
     def handle_accept(self):
-        result = self.accept()
-        if not result:
-            return
-        sock = result[0]
-        self._factory(self, sock)
+        #
+        # Drain the backlog up to a budget, so that a connection storm
+        # does not cost a loop iteration per client. The listening socket
+        # is non-blocking, so accept() returns None when the backlog is
+        # empty, and the dispatcher makes the new socket non-blocking.
+        #
+        self.note_activity()
+        for _ in range(self._accept_budget):
+            if (self._max_connections and
+                    self._connections >= self._max_connections):
+                break
+            result = self.accept()
+            if not result:
+                break
+            sock = result[0]
+            if not self._sockopts_checked:
+                self._check_sockopts(sock)
+            for level, option, value in self._sockopts:
+                try:
+                    sock.setsockopt(level, option, value)
+                except (OSError, socket.error) as error:
+                    logging.debug("http: cannot set option: %s", error)
+            self._factory(self, sock)
 
 def listen(settings):
     """ Listen for HTTP requests """
@@ -150,13 +440,61 @@ def listen(settings):
     settings.setdefault("port", 8080)
     settings.setdefault("routes", {})
     settings.setdefault("file_handler", None)
+    settings.setdefault("max_connections", 0)
+    settings.setdefault("max_inflight", 0)
+    settings.setdefault("max_loop_lag", 0.0)
+    settings.setdefault("retry_after", 1)
+    settings.setdefault("priorities", {})
+    settings.setdefault("accept_budget", 64)
+    settings.setdefault("access_log", None)
+    settings.setdefault("tcp_nodelay", False)
+    settings.setdefault("tcp_defer_accept", 0)
+    settings.setdefault("tcp_fastopen", 0)
+    settings.setdefault("tcp_notsent_lowat", 0)
+    settings.setdefault("sndbuf", 0)
+    settings.setdefault("rcvbuf", 0)
 
     epnt = settings["hostname"], int(settings["port"])
 
-    server = Server(settings["file_handler"])
+    server = Server(settings["file_handler"],
+                    max_connections=settings["max_connections"],
+                    max_inflight=settings["max_inflight"],
+                    max_loop_lag=settings["max_loop_lag"],
+                    retry_after=settings["retry_after"],
+                    accept_budget=settings["accept_budget"],
+                    access_log=settings["access_log"])
     for key in settings["routes"]:
-        server.add_route(key, settings["routes"][key])
+        server.add_route(key, settings["routes"][key],
+                         settings["priorities"].get(key, 0))
     server.create_socket(settings["family"], socket.SOCK_STREAM)
     server.set_reuse_addr()
+    # Buffer sizes are inherited by accepted sockets and the receive
+    # buffer must be set before listen() to affect the window scale
+    if settings["sndbuf"]:
+        _setsockopt(server.socket, socket.SOL_SOCKET, "SO_SNDBUF",
+                    settings["sndbuf"])
+    if settings["rcvbuf"]:
+        _setsockopt(server.socket, socket.SOL_SOCKET, "SO_RCVBUF",
+                    settings["rcvbuf"])
+    if settings["tcp_defer_accept"]:
+        _setsockopt(server.socket, socket.IPPROTO_TCP, "TCP_DEFER_ACCEPT",
+                    settings["tcp_defer_accept"])
+    if settings["tcp_fastopen"]:
+        _setsockopt(server.socket, socket.IPPROTO_TCP, "TCP_FASTOPEN",
+                    settings["tcp_fastopen"])
+    # Options for accepted sockets are resolved and validated once, by
+    # setting them on the listening socket, rather than per connection;
+    # they are set again only where accepted sockets do not inherit them
+    sockopts = []
+    if settings["tcp_nodelay"]:
+        sockopts.append(_setsockopt(server.socket, socket.IPPROTO_TCP,
+                                    "TCP_NODELAY", 1))
+    if settings["tcp_notsent_lowat"]:
+        sockopts.append(_setsockopt(server.socket, socket.IPPROTO_TCP,
+                                    "TCP_NOTSENT_LOWAT",
+                                    settings["tcp_notsent_lowat"]))
+    for sockopt in sockopts:
+        if sockopt:
+            server.add_sockopt(*sockopt)
     server.bind(epnt)
     server.listen(settings["backlog"])
@@ -7,25 +7,140 @@
 
 """ File handler """
 
+import email.utils
+import errno
 import logging
 import mimetypes
 import os
+import threading
+
+from stat import S_ISREG
 
 from .core import RequestHandler
 from . import writer
 
+def _guess_mimetype(path):
+    """ Guess mimetype of the file at path """
+    mimetype, encoding = mimetypes.guess_type(path)
+    if not mimetype:
+        mimetype = "text/plain"
+    return mimetype, encoding
+
+class StaticManifest(object):
+    """
+     Index mapping URL paths to the files below rootdir.
+
+     When rescan_interval is set, a background thread rebuilds the index
+     every rescan_interval seconds and swaps it in, so the event loop
+     never walks the tree. Entries are also refreshed when a served file
+     turns out to have changed, after checking that it is still below
+     rootdir.
+    """
+
+    def __init__(self, rootdir, default_file, rescan_interval=None):
+        self._rootdir = rootdir
+        self._default_file = default_file
+        self._index = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.scan()
+        if rescan_interval is not None:
+            self._thread = threading.Thread(target=self._run,
+                                            args=(rescan_interval,),
+                                            name="neubot-http-manifest")
+            self._thread.daemon = True
+            self._thread.start()
+
+    @staticmethod
+    def make_entry(path, stat):
+        """ Make the index entry for the file at path """
+        mimetype, encoding = _guess_mimetype(path)
+        etag = '"%x-%x"' % (stat.st_size, stat.st_mtime_ns // 1000)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        return (path, stat.st_size, stat.st_mtime_ns, stat.st_dev,
+                stat.st_ino, mimetype, encoding, etag, last_modified)
+
+    def scan(self):
+        """ Walk rootdir and rebuild the index """
+        logging.debug("fh: scanning rootdir %s", self._rootdir)
+        index = {}
+        prefix = self._rootdir.rstrip(os.sep) + os.sep
+        for dirpath, _, filenames in os.walk(self._rootdir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                realpath = os.path.abspath(os.path.realpath(path))
+                if not realpath.startswith(prefix):
+                    logging.warning("fh: not indexing %s: outside rootdir",
+                                    path)
+                    continue
+                try:
+                    stat = os.stat(realpath)
+                except (OSError, IOError):
+                    continue
+                if not S_ISREG(stat.st_mode):
+                    continue
+                entry = self.make_entry(realpath, stat)
+                url = "/" + os.path.relpath(path, self._rootdir).replace(
+                    os.sep, "/")
+                index[url] = entry
+                if name == self._default_file:
+                    url = url[:-len(name)]
+                    index[url] = entry
+                    if len(url) > 1:
+                        index[url[:-1]] = entry
+                    else:
+                        index[""] = entry
+        logging.debug("fh: indexed %d urls", len(index))
+        self._index = index  # Atomic swap
+
+    def _run(self, rescan_interval):
+        """ Background thread main loop """
+        while not self._stop.wait(rescan_interval):
+            try:
+                self.scan()
+            except (OSError, IOError):
+                logging.warning("fh: cannot scan rootdir", exc_info=True)
+
+    def lookup(self, url):
+        """ Return the index entry for url or None """
+        return self._index.get(url)
+
+    def update(self, url, entry):
+        """ Replace the entry for url, or remove it if entry is None """
+        if entry:
+            self._index[url] = entry
+        else:
+            self._index.pop(url, None)
+
+    def close(self):
+        """ Stop the background thread """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
 class FileHandler(object):
     """ File handler class """
 
-    def __init__(self, rootdir, default_file):
+    def __init__(self, rootdir, default_file, manifest=False,
+                 rescan_interval=None):
         logging.debug("fh: user specified rootdir: %s", rootdir)
         rootdir = os.path.abspath(os.path.realpath(os.path.abspath(rootdir)))
         logging.debug("fh: absolute rootdir is: %s", rootdir)
         self._rootdir = rootdir
         self._default_file = default_file
+        self._manifest = None
+        if manifest:
+            self._manifest = StaticManifest(rootdir, default_file,
+                                            rescan_interval)
 
     def __call__(self):
-        return FileRequestHandler(self._rootdir, self._default_file)
+        return FileRequestHandler(self._rootdir, self._default_file,
+                                  self._manifest)
+
+    def close(self):
+        """ Stop the manifest rescan thread, if any """
+        if self._manifest:
+            self._manifest.close()
 
     @property
     def rootdir(self):
@@ -40,9 +155,10 @@ class FileHandler(object):
 class FileRequestHandler(RequestHandler):
     """ File request handler """
 
-    def __init__(self, rootdir, default_file):
+    def __init__(self, rootdir, default_file, manifest=None):
         self._rootdir = rootdir
         self._default_file = default_file
+        self._manifest = manifest
 
     def _resolve_path(self, path):
         """ Safely maps HTTP path to filesystem path """
@@ -62,18 +178,10 @@ class FileRequestHandler(RequestHandler):
 
         return path
 
-    @staticmethod
-    def _guess_mimetype(path):
-        """ Guess mimetype of the file at path """
-        mimetype, encoding = mimetypes.guess_type(path)
-        if not mimetype:
-            mimetype = "text/plain"
-        return mimetype, encoding
-
     def _serve_filep(self, connection, request, path, filep):
         """ Serve the content of a file """
 
-        mimetype, encoding = self._guess_mimetype(path)
+        mimetype, encoding = _guess_mimetype(path)
 
         logging.debug("fh: sending '%s' (i.e., '%s')", request.url, path)
 
@@ -100,6 +208,65 @@ class FileRequestHandler(RequestHandler):
 
         self._serve_filep(connection, request, path, filep)
 
+    def _below_rootdir(self, path, stat):
+        """ Make sure the file opened at path is still below rootdir """
+        realpath = os.path.abspath(os.path.realpath(path))
+        if not realpath.startswith(self._rootdir + os.sep):
+            return False
+        try:
+            current = os.stat(realpath)
+        except (OSError, IOError):
+            return False
+        # Make sure nobody swapped the file after we opened it
+        return (current.st_dev, current.st_ino) == (stat.st_dev, stat.st_ino)
+
+    def _serve_entry(self, connection, request, entry):
+        """ Serve the file described by a manifest entry """
+
+        #
+        # The path was below rootdir at scan time, but since then it may
+        # have been replaced by a symlink. O_NOFOLLOW catches that for the
+        # last component; for the others we check the real path again
+        # whenever the file is not the one we indexed.
+        #
+        try:
+            filep = os.fdopen(os.open(entry[0], os.O_RDONLY |
+                                      getattr(os, "O_NOFOLLOW", 0)), "rb")
+        except (OSError, IOError) as error:
+            self._manifest.update(request.url, None)
+            if error.errno == errno.ELOOP:
+                connection.write(writer.compose_response_error(
+                    403, "Forbidden"))
+                return
+            connection.write(writer.compose_response_error(404, "Not Found"))
+            return
+        stat = os.fstat(filep.fileno())
+
+        if (stat.st_size, stat.st_mtime_ns, stat.st_dev,
+                stat.st_ino) != entry[1:5]:
+            if not self._below_rootdir(entry[0], stat):
+                logging.warning("fh: %s escapes rootdir", entry[0])
+                filep.close()
+                self._manifest.update(request.url, None)
+                connection.write(writer.compose_response_error(
+                    403, "Forbidden"))
+                return
+            logging.debug("fh: refreshing stale entry for %s", request.url)
+            entry = self._manifest.make_entry(entry[0], stat)
+            self._manifest.update(request.url, entry)
+
+        path, size, _, _, _, mimetype, encoding, etag, last_modified = entry
+
+        logging.debug("fh: sending '%s' (i.e., '%s')", request.url, path)
+
+        connection.write(writer.compose_response_filep(200, "Ok", {
+            "Content-Type": mimetype,
+            "Content-Encoding": encoding,
+            "Content-Length": size,
+            "ETag": etag,
+            "Last-Modified": last_modified,
+        }, filep))
+
     def _serve_directory(self, connection, request, path):
         """ Serve the directory at path """
         path = os.sep.join([path, self._default_file])
@@ -116,6 +283,13 @@ class FileRequestHandler(RequestHandler):
 
         logging.debug("fh: requested to serve: %s", request.url)
 
+        if self._manifest:
+            entry = self._manifest.lookup(request.url)
+            if entry:
+                self._serve_entry(connection, request, entry)
+                return
+            # Fall back to resolving the path, the index may be stale
+
         path = self._resolve_path(request.url)
         if not path:
             connection.write(writer.compose_response_error(403, "Forbidden"))
@@ -8,9 +8,12 @@
 """ HTTP parser """
 
 import logging
+import re
 
 from .messages import Message
 
+_NEWLINE = re.compile(b"\n")
+
 class Error(RuntimeError):
     """ Indicates a protocol error """
 
@@ -23,16 +26,34 @@ class Parser(object):
         self._incoming = []
         self._maxheaders = 128
         self._maxline = 32768
+        self._no_body = False
 
     def eof(self):
         """ Tell the parser we've hit EOF """
         logging.debug("* EOF")
         self._eof_flag = True
 
+    def expect_no_body(self):
+        """ Tell the parser the next final response has no body (HEAD) """
+        self._no_body = True
+
     def feed(self, data):
-        """ Feed the parser with new data """
+        """
+         Feed the parser with new data.
+
+         The data may be any bytes-like object, including a memoryview
+         on a reusable receive buffer, provided that detach() is called
+         before the buffer is reused.
+        """
         self._incoming.append(data)
 
+    def detach(self):
+        """ Copy the unparsed data, so the fed buffers can be reused """
+        for elem in self._incoming:
+            if not isinstance(elem, bytes):
+                self._incoming = [b"".join(self._incoming)]
+                break
+
     def parse(self):
         """ Parse data previously bufferized """
         try:
@@ -40,26 +61,31 @@ class Parser(object):
         except StopIteration:
             return ()
 
+    def _buffered(self):
+        """ Return buffered data as a single bytes-like object """
+        #
+        # After detach() there is at most one bytes object, and feed()
+        # appends a view on the receive buffer, so we join only when a
+        # partial line or chunk was left over by the previous read.
+        #
+        if len(self._incoming) != 1:
+            self._incoming = [b"".join(self._incoming)]
+        return self._incoming[0]
+
     def _readline_internal(self, maxline):
         """ Read a line from the input buffer (implementation) """
-        data = b"".join(self._incoming)
-        pos = data.find(b"\r\n")
-        if pos < 0:
-            pos = data.find(b"\n")
-            if pos == -1:
-                if len(data) > maxline:
-                    return -1, ""
-                return 0, ""
-            else:
-                pos += 1
-        else:
-            pos += 2
-        line = data[:pos]
+        data = self._buffered()
+        match = _NEWLINE.search(data)  # Works on views without copying
+        if not match:
+            if len(data) > maxline:
+                return -1, ""
+            return 0, ""
+        pos = match.end()
         #
         # If I understand RFC2616 Sect. 2.2 correctly, <TEXT> must
         # be ISO-8859-1, otherwise it must be MIME encoded.
         #
-        line = line.decode("iso-8859-1")
+        line = str(data[:pos], "iso-8859-1")
         self._incoming = [data[pos:]]
         return len(line), line
 
@@ -75,9 +101,11 @@ class Parser(object):
 
     def _read(self, desired):
         """ Read from the input buffer """
-        data = b"".join(self._incoming)
+        data = self._buffered()
         self._incoming = [data[desired:]]
         data = data[:desired]
+        if not isinstance(data, bytes):
+            data = data.tobytes()  # Handlers may keep it after detach()
         return data
 
     def _coroutine(self):
@@ -136,7 +164,12 @@ class Parser(object):
                                               first_line[2], headers)
                 yield ("request", message)
 
-            if headers.get("transfer-encoding") == "chunked":
+            if isresponse and self._no_body and first_line[1][0:1] != "1":
+                logging.debug("* RESPONSE_TO_HEAD")
+                self._no_body = False
+                yield ("end", message)
+
+            elif headers.get("transfer-encoding") == "chunked":
 
                 while True:
 
@@ -204,13 +237,14 @@ class Parser(object):
             elif isresponse and (headers.get("connection") != "keep-alive" or
                                  first_line[0] == "HTTP/1.0"):
                 logging.debug("* CONNECTION_CLOSE")
-                while not self._eof_flag:
+                while True:
                     data = self._read(65535)
-                    if not data:
-                        yield ()
+                    if data:
+                        yield ("data", message, data)
                         continue
-                    length -= len(data)
-                    yield ("data", message, data)
+                    if self._eof_flag:
+                        break
+                    yield ()
                 yield ("end", message)
                 return  # Reached final state
 
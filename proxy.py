@@ -0,0 +1,338 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Streaming reverse proxy """
+
+import asyncore
+import logging
+import socket
+
+from .core import RequestHandler
+from .outqueue import OutputQueue
+from .parser import Parser
+
+from . import writer
+
+HOP_BY_HOP = frozenset([
+    "connection",
+    "content-length",
+    "expect",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+])
+
+def _compose_head(first_line, headers):
+    """ Compose first line and headers of a message """
+    lines = [first_line]
+    for name, value in headers.items():
+        lines.append("%s: %s" % (name, value))
+    lines.append("\r\n")
+    return "\r\n".join(lines)
+
+class UpstreamConnection(asyncore.dispatcher):
+    """ Keep-alive connection to a backend """
+
+    def __init__(self, pool, backend, family=socket.AF_INET, mapx=None):
+        asyncore.dispatcher.__init__(self, map=mapx)
+        self._backend = backend
+        self._handler = None
+        self._parser = Parser()
+        self._pool = pool
+        self._queue = OutputQueue()
+        self.create_socket(family, socket.SOCK_STREAM)
+        logging.debug("proxy: connecting to %s", backend)
+        self.connect(backend)
+
+    @property
+    def backend(self):
+        """ Get backend address """
+        return self._backend
+
+    @property
+    def queue_depth(self):
+        """ Get the number of elements waiting to be sent """
+        return len(self._queue)
+
+    def attach(self, handler):
+        """ Attach the handler that receives the responses """
+        self._handler = handler
+
+    def detach(self):
+        """ Detach the current handler """
+        self._handler = None
+
+    def write(self, data):
+        """ Write bytes, str or generator to socket """
+        self._queue.insert_data(data)
+
+    def expect_no_body(self):
+        """ The response to the request being sent has no body (HEAD) """
+        self._parser.expect_no_body()
+
+    def handle_connect(self):
+        logging.debug("proxy: connected to %s", self._backend)
+
+    def readable(self):
+        if self._handler:
+            return self._handler.upstream_readable()
+        return True  # So that we notice when idle connections are closed
+
+    def writable(self):
+        return self.connecting or bool(self._queue)
+
+    def handle_read(self):
+        data = self.recv(65536)  # Calls handle_close() on EOF
+        if data:
+            self._parser.feed(data)
+            self._process()
+
+    def handle_close(self):
+        # The EOF may terminate the body of the response
+        self._parser.eof()
+        self._process()
+        self.close()
+
+    def _process(self):
+        """ Emit the events for buffered data """
+        result = self._parser.parse()
+        while result:
+            if not self._handler:
+                logging.warning("proxy: unexpected response from %s",
+                                self._backend)
+                self.close()
+                return
+            if result[0] == "response":
+                self._handler.on_upstream_response(self, result[1])
+            elif result[0] == "data":
+                self._handler.on_upstream_data(self, result[2])
+            elif result[0] == "end":
+                self._handler.on_upstream_end(self, result[1])
+            else:
+                raise RuntimeError
+            result = self._parser.parse()
+
+    def handle_write(self):
+        chunk = self._queue.get_next_chunk()
+        if chunk:
+            chunk = chunk[self.send(chunk):]
+            if chunk:
+                self._queue.reinsert_partial_chunk(chunk)
+        if self._handler:
+            self._handler.on_upstream_drain(self)
+
+    def handle_error(self):
+        logging.warning("proxy: error with %s", self._backend,
+                        exc_info=True)
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._pool.discard(self)
+        handler, self._handler = self._handler, None
+        if handler:
+            handler.on_upstream_close(self)
+
+class UpstreamPool(object):
+    """ Pool of keep-alive connections to a set of backends """
+
+    def __init__(self, backends, max_idle=8, family=socket.AF_INET):
+        self._backends = list(backends)
+        self._family = family
+        self._idle = {}
+        self._max_idle = max_idle
+        self._next = 0
+
+    def acquire(self):
+        """ Get a connection to the next backend in round robin order """
+        backend = self._backends[self._next % len(self._backends)]
+        self._next += 1
+        idle = self._idle.get(backend, [])
+        while idle:
+            upstream = idle.pop()
+            if upstream.connected:
+                logging.debug("proxy: reusing connection to %s", backend)
+                return upstream
+        return UpstreamConnection(self, backend, self._family)
+
+    def release(self, upstream):
+        """ Return a connection to the pool """
+        idle = self._idle.setdefault(upstream.backend, [])
+        if len(idle) >= self._max_idle:
+            upstream.close()
+            return
+        idle.append(upstream)
+
+    def discard(self, upstream):
+        """ Forget a closed connection """
+        idle = self._idle.get(upstream.backend, [])
+        if upstream in idle:
+            idle.remove(upstream)
+
+class ProxyRequestHandler(RequestHandler):
+    """ Forwards a request to a backend and streams back the response """
+
+    def __init__(self, pool, max_queue):
+        self._chunked_request = False
+        self._chunked_response = False
+        self._connection = None
+        self._head = False
+        self._max_queue = max_queue
+        self._pool = pool
+        self._request_ended = False
+        self._response_started = False
+        self._upstream = None
+
+    def _update_reading(self):
+        """ Pause client while upstream is behind or until response """
+        if self._upstream and (not self._request_ended and
+                               self._upstream.queue_depth < self._max_queue):
+            self._connection.resume_reading()
+        else:
+            self._connection.pause_reading()
+
+    def on_request(self, connection, request):
+        if request["expect"].lower() == "100-continue":
+            connection.write(writer.compose_headers("100", "Continue", {}))
+        self._connection = connection
+        self._upstream = self._pool.acquire()
+        self._upstream.attach(self)
+        connection.add_close_callback(self._on_client_close)
+        if request.method == "HEAD":
+            self._head = True
+            self._upstream.expect_no_body()
+        headers = {}
+        for name, value in request.headers.items():
+            if name not in HOP_BY_HOP:
+                headers[name] = value
+        if request["transfer-encoding"].lower() == "chunked":
+            self._chunked_request = True
+            headers["transfer-encoding"] = "chunked"
+        elif request["content-length"]:
+            headers["content-length"] = request["content-length"]
+        if connection.addr:
+            forwarded = request["x-forwarded-for"]
+            if forwarded:
+                forwarded += ", "
+            headers["x-forwarded-for"] = forwarded + str(connection.addr[0])
+        logging.debug("proxy: %s %s -> %s", request.method, request.url,
+                      self._upstream.backend)
+        self._upstream.write(_compose_head("%s %s HTTP/1.1" % (
+            request.method, request.url), headers))
+
+    def on_data(self, connection, request, chunk):
+        if not self._upstream:
+            return
+        if self._chunked_request:
+            self._upstream.write(writer.compose_chunk(chunk))
+        else:
+            self._upstream.write(chunk)
+        self._update_reading()
+
+    def on_end(self, connection, request):
+        if not self._upstream:
+            return
+        if self._chunked_request:
+            self._upstream.write(writer.compose_last_chunk())
+        self._request_ended = True
+        self._update_reading()
+
+    def _on_client_close(self):
+        """ Called when the client closes before the end of response """
+        upstream, self._upstream = self._upstream, None
+        if upstream:
+            # The backend may still be waiting for the request body
+            upstream.detach()
+            upstream.close()
+
+    def upstream_readable(self):
+        """ Read from upstream only when the client keeps up """
+        return (not self._connection.connected or
+                self._connection.queue_depth < self._max_queue)
+
+    def on_upstream_drain(self, upstream):
+        """ Called when upstream has sent some data """
+        self._update_reading()
+
+    def on_upstream_response(self, upstream, response):
+        """ Called when upstream response headers are received """
+        if response.code[0:1] == "1":
+            return  # We handled "Expect: 100-continue" ourselves
+        self._response_started = True
+        headers = {}
+        for name, value in response.headers.items():
+            if name not in HOP_BY_HOP:
+                headers[name] = value
+        if response["content-length"]:
+            headers["content-length"] = response["content-length"]
+        elif not self._head and response.code not in ("204", "304"):
+            self._chunked_response = True
+            headers["transfer-encoding"] = "chunked"
+        self._connection.write(_compose_head("HTTP/1.1 %s %s" % (
+            response.code, response.reason), headers))
+
+    def on_upstream_data(self, upstream, data):
+        """ Called when a piece of upstream response body is received """
+        if not self._connection.connected:
+            upstream.close()
+            return
+        if self._chunked_response:
+            self._connection.write(writer.compose_chunk(data))
+        else:
+            self._connection.write(data)
+
+    def on_upstream_end(self, upstream, response):
+        """ Called at the end of the upstream response """
+        if response.code[0:1] == "1":
+            return
+        if self._chunked_response:
+            self._connection.write(writer.compose_last_chunk())
+        upstream.detach()
+        self._upstream = None
+        self._connection.remove_close_callback(self._on_client_close)
+        if (self._request_ended and response.protocol == "HTTP/1.1" and
+                response["connection"].lower() != "close"):
+            self._pool.release(upstream)
+        else:
+            upstream.close()
+        self._connection.resume_reading()
+
+    def on_upstream_close(self, upstream):
+        """ Called when upstream is closed before the end of response """
+        self._upstream = None
+        self._connection.remove_close_callback(self._on_client_close)
+        if self._response_started:
+            self._connection.close()  # Cannot recover mid-response
+            return
+        logging.warning("proxy: %s failed", upstream.backend)
+        self._connection.write(writer.compose_response_error(
+            "502", "Bad Gateway"))
+        self._connection.resume_reading()
+
+class ReverseProxy(object):
+    """
+     Reverse proxy handler factory.
+
+     Requests are forwarded to backends in round robin order, reusing
+     keep-alive connections. Bodies are streamed in both directions and
+     reading from one side is paused while the queue of the other side
+     holds max_queue or more elements.
+    """
+
+    def __init__(self, backends, max_idle=8, max_queue=16,
+                 family=socket.AF_INET):
+        self._pool = UpstreamPool(backends, max_idle, family)
+        self._max_queue = max_queue
+
+    def __call__(self):
+        return ProxyRequestHandler(self._pool, self._max_queue)
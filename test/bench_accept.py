@@ -0,0 +1,107 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+"""
+ Benchmark of the connection establishment rate.
+
+ Runs the server in a child process with each listen() setting enabled
+ on its own, and measures how many connect/request/response/close
+ cycles per second a pool of client threads completes over loopback.
+
+ Usage: python -m neubot_http.test.bench_accept [connections] [threads]
+"""
+
+import asyncore
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+
+from ..core import RequestProcessor, listen
+from .. import writer
+
+CONFIGS = (
+    ("baseline", {}),
+    ("accept_budget=1", {"accept_budget": 1}),
+    ("tcp_nodelay", {"tcp_nodelay": True}),
+    ("tcp_defer_accept", {"tcp_defer_accept": 1}),
+    ("tcp_fastopen", {"tcp_fastopen": 64}),
+    ("sndbuf+rcvbuf", {"sndbuf": 262144, "rcvbuf": 262144}),
+    ("tcp_notsent_lowat", {"tcp_notsent_lowat": 16384}),
+)
+
+REQUEST = b"GET /bench HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n"
+
+@RequestProcessor
+def _bench(connection, _):
+    """ Reply with a small body """
+    connection.write(writer.compose_response("200", "Ok", {}, "ok"))
+
+def _serve(port, settings, ready):
+    """ Child process main """
+    settings = dict(settings)
+    settings.update({
+        "backlog": 1024,
+        "hostname": "127.0.0.1",
+        "port": port,
+        "routes": {"/bench": _bench},
+    })
+    listen(settings)
+    ready.set()
+    asyncore.loop()
+
+def _client(port, count, errors):
+    """ Client thread main """
+    for _ in range(count):
+        try:
+            sock = socket.create_connection(("127.0.0.1", port))
+            sock.sendall(REQUEST)
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    errors.append(1)  # Closed before the response
+                    break
+                if data.endswith(b"ok"):
+                    break
+            sock.close()
+        except (OSError, socket.error):
+            errors.append(1)
+
+def measure(port, settings, connections, threads):
+    """ Return connections per second with settings """
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=_serve,
+                                     args=(port, settings, ready))
+    server.start()
+    ready.wait()
+    errors = []
+    workers = [threading.Thread(target=_client,
+                                args=(port, connections // threads, errors))
+               for _ in range(threads)]
+    begin = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - begin
+    server.terminate()
+    server.join()
+    return (connections - len(errors)) / elapsed, len(errors)
+
+def main(args):
+    """ Main function """
+    connections = int(args[0]) if args else 5000
+    threads = int(args[1]) if len(args) > 1 else 32
+    port = 18600
+    for name, settings in CONFIGS:
+        rate, errors = measure(port, settings, connections, threads)
+        print("%-20s %8.0f conn/s  (%d errors)" % (name, rate, errors))
+        port += 1
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
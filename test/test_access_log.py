@@ -0,0 +1,105 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the access_log module """
+
+import io
+import socket
+import unittest
+
+from ..access_log import AccessLog
+from ..core import RequestDispatcher, RequestProcessor, Server
+from .. import writer
+
+def _entries(stream):
+    """ Return the fields of the entries written on stream """
+    return [line.split("] ", 1)[1].rsplit(" ", 1)[0]
+            for line in stream.getvalue().splitlines()]
+
+class AccessLogTest(unittest.TestCase):
+    """ Tests for AccessLog """
+
+    def setUp(self):
+        self._stream = io.StringIO()
+
+    def test_batch(self):
+        """ Make sure entries are written on close """
+        log = AccessLog(self._stream, interval=60.0)
+        log.record("GET", "/a", "200", 10, 0.5)
+        log.record("GET", "/b", "", 0, 0.5)
+        log.close()
+        self.assertEqual(_entries(self._stream),
+                         ['"GET /a" 200 10', '"GET /b" - 0'])
+
+    def test_sampling_and_drops(self):
+        """ Make sure entries are sampled and then dropped under load """
+        log = AccessLog(self._stream, size=16, interval=60.0,
+                        sample_threshold=8, sample_rate=2)
+        for _ in range(40):
+            log.record("GET", "/", "200", 1, 0.0)
+        log.close()
+        self.assertEqual(len(_entries(self._stream)), 16)
+        self.assertEqual(log.dropped, 16)
+
+class RequestDispatcherAccessLogTest(unittest.TestCase):
+    """ Tests for access logging in RequestDispatcher """
+
+    def setUp(self):
+        self._stream = io.StringIO()
+        self._log = AccessLog(self._stream, interval=60.0)
+        self._deferred = []
+
+        @RequestProcessor
+        def echo(connection, request):
+            """ Reply with the request URL """
+            connection.write(writer.compose_response("200", "Ok", {},
+                                                     request.url))
+
+        @RequestProcessor
+        def defer(connection, _):
+            """ Reply later """
+            self._deferred.append(connection)
+
+        self._server = Server(access_log=self._log)
+        self._server.add_route("/a", echo)
+        self._server.add_route("/defer", defer)
+        self._client, sock = socket.socketpair()
+        self._map = {}
+        self._dispatcher = RequestDispatcher(self._server, sock, self._map)
+
+    def tearDown(self):
+        self._dispatcher.close()
+        self._client.close()
+
+    def _flush(self):
+        """ Send everything the dispatcher has queued """
+        while self._dispatcher.writable():
+            self._dispatcher.handle_write()
+
+    def test_pipelined(self):
+        """ Make sure pipelined requests get their own status and size """
+        self._client.sendall(b"GET /a HTTP/1.1\r\n\r\n"
+                             b"GET /nope HTTP/1.1\r\n\r\n")
+        self._dispatcher.handle_read()
+        self._flush()
+        self._log.close()
+        self.assertEqual(_entries(self._stream),
+                         ['"GET /a" 200 40', '"GET /nope" 404 262'])
+
+    def test_response_over_many_writes(self):
+        """ Make sure responses are logged after their last byte """
+        self._client.sendall(b"GET /defer HTTP/1.1\r\n\r\n")
+        self._dispatcher.handle_read()
+        self._deferred[0].write(writer.compose_headers("200", "Ok", {
+            "Transfer-Encoding": "chunked"}))
+        self._flush()
+        self._deferred[0].write(writer.compose_chunk(b"x" * 10000))
+        self._deferred[0].write(writer.compose_last_chunk())
+        self._flush()
+        self._log.close()
+        self.assertEqual(_entries(self._stream),
+                         ['"GET /defer" 200 10060'])
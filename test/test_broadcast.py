@@ -0,0 +1,113 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the broadcast module """
+
+import unittest
+
+from ..broadcast import BroadcastHub
+from ..outqueue import OutputQueue
+
+class _Connection(object):
+    """ Connection that records what is sent """
+
+    def __init__(self):
+        self.connected = True
+        self.queue = OutputQueue()
+
+    def close(self):
+        """ Close connection """
+        self.connected = False
+
+    def detach_inflight(self):
+        """ Stop counting the request as in flight """
+
+    @property
+    def queue_depth(self):
+        """ Get the number of elements waiting to be sent """
+        return len(self.queue)
+
+    def write(self, data):
+        """ Write data """
+        self.queue.insert_data(data)
+
+    def sent(self):
+        """ Send what is queued and return it """
+        pieces = []
+        chunk = self.queue.get_next_chunk()
+        while chunk is not None:
+            pieces.append(chunk.tobytes())
+            chunk = self.queue.get_next_chunk()
+        return b"".join(pieces)
+
+class BroadcastHubTest(unittest.TestCase):
+    """ Tests for BroadcastHub """
+
+    @staticmethod
+    def _subscribe(hub, count):
+        """ Subscribe count connections and discard the headers """
+        connections = [_Connection() for _ in range(count)]
+        for connection in connections:
+            hub.subscribe(connection)
+            connection.sent()
+        return connections
+
+    def test_publish(self):
+        """ Make sure the same frame reaches every subscriber """
+        hub = BroadcastHub()
+        connections = self._subscribe(hub, 3)
+        hub.publish("data: x\n\n")
+        hub.publish(bytearray(b"data: y\n\n"))
+        hub.publish(memoryview(b"data: z\n\n"))
+        for connection in connections:
+            self.assertEqual(connection.sent(), b"9\r\ndata: x\n\n\r\n"
+                                                b"9\r\ndata: y\n\n\r\n"
+                                                b"9\r\ndata: z\n\n\r\n")
+
+    def test_drop_slow(self):
+        """ Make sure a slow subscriber is dropped """
+        hub = BroadcastHub(max_queue=2)
+        slow, fast = self._subscribe(hub, 2)
+        for _ in range(3):
+            hub.publish(b"x")
+            fast.sent()
+        self.assertFalse(slow.connected)
+        self.assertEqual(len(hub), 1)
+        self.assertEqual(slow.sent(), b"1\r\nx\r\n" * 2)
+
+    def test_skip_slow(self):
+        """ Make sure a slow subscriber skips events without drop_slow """
+        hub = BroadcastHub(max_queue=2, drop_slow=False)
+        slow, fast = self._subscribe(hub, 2)
+        for data in (b"a", b"b", b"c"):
+            hub.publish(data)
+            self.assertEqual(fast.sent(), b"1\r\n" + data + b"\r\n")
+        self.assertTrue(slow.connected)
+        self.assertEqual(slow.sent(), b"1\r\na\r\n1\r\nb\r\n")
+        hub.publish(b"d")  # It caught up
+        self.assertEqual(slow.sent(), b"1\r\nd\r\n")
+        self.assertEqual(len(hub), 2)
+
+    def test_heartbeat(self):
+        """ Make sure periodic() sends heartbeats to idle subscribers """
+        hub = BroadcastHub(heartbeat_interval=0.0)
+        connection, = self._subscribe(hub, 1)
+        hub.periodic()
+        self.assertEqual(connection.sent(), b"3\r\n:\n\n\r\n")
+        hub = BroadcastHub(heartbeat_interval=3600.0)
+        connection, = self._subscribe(hub, 1)
+        hub.periodic()
+        self.assertEqual(connection.sent(), b"")
+
+    def test_forget_closed(self):
+        """ Make sure closed subscribers are forgotten """
+        hub = BroadcastHub()
+        closed, _ = self._subscribe(hub, 2)
+        closed.close()
+        hub.periodic()
+        self.assertEqual(len(hub), 1)
+        self.assertEqual(closed.sent(), b"")
@@ -0,0 +1,195 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the cache module """
+
+import socket
+import unittest
+
+from ..cache import ResponseCache, cached
+from ..core import RequestDispatcher, RequestProcessor, Server
+from ..messages import Message
+from ..outqueue import OutputQueue
+from .. import writer
+
+class _Connection(object):
+    """ Connection that records what is sent """
+
+    def __init__(self):
+        self._callbacks = []
+        self.connected = True
+        self.paused = False
+        self.queue = OutputQueue()
+
+    def add_close_callback(self, callback):
+        """ Add close callback """
+        self._callbacks.append(callback)
+
+    def remove_close_callback(self, callback):
+        """ Remove close callback """
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def close(self):
+        """ Close connection """
+        self.connected = False
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def pause_reading(self):
+        """ Pause reading """
+        self.paused = True
+
+    def resume_reading(self):
+        """ Resume reading """
+        self.paused = False
+
+    def write(self, data):
+        """ Write data """
+        self.queue.insert_data(data)
+
+    def sent(self):
+        """ Send what is queued and return it """
+        pieces = []
+        chunk = self.queue.get_next_chunk()
+        while chunk is not None:
+            pieces.append(chunk.tobytes())
+            chunk = self.queue.get_next_chunk()
+        return b"".join(pieces)
+
+def _get(processor, url="/status"):
+    """ Process a GET request and return the connection """
+    connection = _Connection()
+    processor.on_end(connection, Message.request("GET", url, "HTTP/1.1", {}))
+    return connection
+
+class CachedRequestProcessorTest(unittest.TestCase):
+    """ Tests for CachedRequestProcessor """
+
+    def setUp(self):
+        self._calls = []
+
+    def _processor(self, reply=True, **kwargs):
+        """ Make a cached processor counting calls """
+
+        @cached(10, cache=ResponseCache(kwargs.pop("max_bytes", 65536)),
+                **kwargs)
+        def status(connection, _):
+            """ Reply or defer the reply """
+            self._calls.append(connection)
+            if reply:
+                connection.write(writer.compose_response("200", "Ok", {},
+                                                         "status"))
+
+        return status
+
+    def test_hit(self):
+        """ Make sure the second request is served from the cache """
+        processor = self._processor()
+        first = _get(processor).sent()
+        self.assertTrue(first.endswith(b"status"))
+        self.assertEqual(_get(processor).sent(), first)
+        self.assertEqual(len(self._calls), 1)
+
+    def test_lazy_capture(self):
+        """ Make sure generators are not drained when written """
+
+        def generator():
+            """ Body that must not be consumed by write() """
+            consumed.append(True)
+            yield "x"
+
+        consumed = []
+        processor = self._processor(reply=False)
+        connection = _get(processor)
+        self._calls[0].write(writer.compose_response_generator("200", "Ok", {
+            "Transfer-Encoding": "chunked"}, generator()))
+        self.assertEqual(consumed, [])
+        self._calls[0].write(writer.compose_last_chunk())
+        self.assertTrue(connection.sent().endswith(b"1\r\nx\r\n0\r\n\r\n"))
+        self.assertEqual(consumed, [True])
+
+    def test_coalescing(self):
+        """ Make sure concurrent misses share the response """
+        processor = self._processor(reply=False)
+        leader, waiter = _get(processor), _get(processor)
+        self.assertEqual(len(self._calls), 1)
+        self.assertTrue(waiter.paused)
+        self._calls[0].write(writer.compose_response("200", "Ok", {}, "late"))
+        self.assertTrue(leader.sent().endswith(b"late"))
+        self.assertTrue(waiter.sent().endswith(b"late"))
+        self.assertFalse(waiter.paused)
+        self.assertTrue(_get(processor).sent().endswith(b"late"))
+        self.assertEqual(len(self._calls), 1)
+
+    def test_leader_closed(self):
+        """ Make sure waiters are processed when the leader closes """
+        processor = self._processor(reply=False)
+        _get(processor)
+        waiter = _get(processor)
+        self._calls[0].close()
+        self.assertEqual(len(self._calls), 2)
+        self.assertIs(self._calls[1], waiter)
+        self.assertFalse(waiter.paused)
+        _get(processor)
+        self.assertEqual(len(self._calls), 3)
+
+    def test_fill_timeout(self):
+        """ Make sure a stuck fill is abandoned after fill_timeout """
+        processor = self._processor(reply=False, fill_timeout=0.0)
+        _get(processor)
+        _get(processor)
+        self.assertEqual(len(self._calls), 2)
+
+    def test_too_large(self):
+        """ Make sure responses larger than the budget are not cached """
+        processor = self._processor(max_bytes=16)
+        _get(processor, "/a").sent()
+        waiter = _get(processor, "/a")
+        self.assertTrue(waiter.sent().endswith(b"status"))
+        self.assertEqual(len(self._calls), 2)
+
+    def test_pipelined_waiter(self):
+        """ Make sure requests pipelined after a waiter wait for it """
+        mapx = {}
+
+        @RequestProcessor
+        def echo(connection, request):
+            """ Reply with the request URL """
+            connection.write(writer.compose_response("200", "Ok", {},
+                                                     request.url))
+
+        server = Server()
+        server.add_route("/status", self._processor(reply=False))
+        server.add_route("/echo", echo)
+        sockets = socket.socketpair() + socket.socketpair()
+        try:
+            leader = RequestDispatcher(server, sockets[1], mapx)
+            waiter = RequestDispatcher(server, sockets[3], mapx)
+            sockets[0].sendall(b"GET /status HTTP/1.1\r\n\r\n")
+            leader.handle_read()
+            sockets[2].sendall(b"GET /status HTTP/1.1\r\n\r\n"
+                               b"GET /echo HTTP/1.1\r\n\r\n")
+            waiter.handle_read()
+            self.assertFalse(waiter.writable())
+            self._calls[0].write(writer.compose_response("200", "Ok", {},
+                                                         "late"))
+            while leader.writable():
+                leader.handle_write()  # Completes the fill
+            data = b""
+            while waiter.writable():
+                waiter.handle_write()
+            sockets[2].settimeout(1.0)
+            while not data.endswith(b"/echo"):
+                data += sockets[2].recv(65536)
+            self.assertLess(data.index(b"late"), data.index(b"/echo"))
+        finally:
+            for dispatcher in list(mapx.values()):
+                dispatcher.close()
+            for sock in sockets:
+                sock.close()
@@ -0,0 +1,305 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the core module """
+
+import socket
+import sys
+import time
+import unittest
+
+from ..broadcast import BroadcastHub
+from ..core import RequestDispatcher, RequestHandler, RequestProcessor
+from ..core import Server
+from .. import writer
+
+def _make_server(**kwargs):
+    """ Make a server with echo routes and a route that defers reply """
+
+    @RequestProcessor
+    def echo(connection, request):
+        """ Reply with the request URL """
+        connection.write(writer.compose_response("200", "Ok", {},
+                                                 request.url))
+
+    @RequestProcessor
+    def defer(connection, _):
+        """ Reply later """
+        server.deferred.append(connection)
+
+    server = Server(**kwargs)
+    server.deferred = []
+    server.add_route("/aaaa", echo)
+    server.add_route("/bbbb", echo)
+    server.add_route("/defer", defer)
+    server.add_route("/health", echo, priority=1)
+    return server
+
+def _read_response(sock):
+    """ Read a response with small body from sock """
+    sock.settimeout(1.0)
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += sock.recv(65536)
+    head, body = data.split(b"\r\n\r\n", 1)
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, value = line.split(b":", 1)
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    while len(body) < length:
+        body += sock.recv(65536)
+    return head.split(b"\r\n")[0], body
+
+class RequestDispatcherTest(unittest.TestCase):
+    """ Tests for RequestDispatcher """
+
+    def setUp(self):
+        self._map = {}
+        self._server = _make_server()
+        self._sockets = []
+
+    def tearDown(self):
+        for sock in self._sockets:
+            sock.close()
+        for dispatcher in list(self._map.values()):
+            dispatcher.close()
+
+    def _connect(self):
+        """ Make a client socket and the dispatcher serving it """
+        client, server = socket.socketpair()
+        self._sockets.append(client)
+        return client, RequestDispatcher(self._server, server, self._map)
+
+    @staticmethod
+    def _flush(dispatcher):
+        """ Send everything that the dispatcher has queued """
+        while dispatcher.writable():
+            dispatcher.handle_write()
+
+    def test_split_request_while_other_connection_reads(self):
+        """ Make sure a partial request survives reads by others """
+        client_a, dispatcher_a = self._connect()
+        client_b, dispatcher_b = self._connect()
+
+        client_a.sendall(b"GET /aaaa HTT")
+        dispatcher_a.handle_read()
+        client_b.sendall(b"GET /bbbb HTTP/1.1\r\n\r\n")
+        dispatcher_b.handle_read()
+        client_a.sendall(b"P/1.1\r\nHost: a\r\n\r\n")
+        dispatcher_a.handle_read()
+
+        self._flush(dispatcher_a)
+        self._flush(dispatcher_b)
+        self.assertEqual(_read_response(client_a),
+                         (b"HTTP/1.1 200 Ok", b"/aaaa"))
+        self.assertEqual(_read_response(client_b),
+                         (b"HTTP/1.1 200 Ok", b"/bbbb"))
+
+    def test_split_headers_while_other_connection_reads(self):
+        """ Make sure partial headers survive reads by others """
+        client_a, dispatcher_a = self._connect()
+        client_b, dispatcher_b = self._connect()
+
+        client_a.sendall(b"GET /aaaa HTTP/1.1\r\nHost: aaaa")
+        dispatcher_a.handle_read()
+        client_b.sendall(b"GET /bbbb HTTP/1.1\r\nHost: bbbbbbbbbbbbbbb\r\n")
+        dispatcher_b.handle_read()
+        client_a.sendall(b"\r\n\r\n")
+        dispatcher_a.handle_read()
+
+        self._flush(dispatcher_a)
+        self.assertEqual(_read_response(client_a),
+                         (b"HTTP/1.1 200 Ok", b"/aaaa"))
+
+    def test_read_budget(self):
+        """ Make sure a read event stops after read_budget bytes """
+        chunks = []
+
+        class Upload(RequestHandler):
+            """ Remember the body chunks """
+
+            def __call__(self):
+                return self
+
+            def on_data(self, connection, request, chunk):
+                chunks.append(chunk)
+
+        self._server.add_route("/upload", Upload())
+        client, dispatcher = self._connect()
+        dispatcher._read_budget = 8192
+        head = b"PUT /upload HTTP/1.1\r\nContent-Length: 65536\r\n\r\n"
+        client.sendall(head + b"A" * 32768)
+        dispatcher.handle_read()
+        # Two reads: 4096 bytes, then 8192 bytes after growing
+        self.assertEqual(sum(len(chunk) for chunk in chunks),
+                         4096 + 8192 - len(head))
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+        dispatcher.handle_read()
+        self.assertEqual(sum(len(chunk) for chunk in chunks),
+                         4096 + 8192 + 16384 - len(head))
+
+    def test_adapt_read_size(self):
+        """ Make sure the read size grows for bulk and shrinks back """
+        _, dispatcher = self._connect()
+        self.assertEqual(dispatcher._read_size, 4096)
+        for _ in range(10):
+            dispatcher._adapt_read_size(dispatcher._read_size)
+        self.assertEqual(dispatcher._read_size, 262144)
+        dispatcher._adapt_read_size(65536)
+        self.assertEqual(dispatcher._read_size, 262144)
+        for _ in range(10):
+            dispatcher._adapt_read_size(100)
+        self.assertEqual(dispatcher._read_size, 4096)
+
+    def test_inflight_pipelined(self):
+        """ Make sure pipelined requests count until their reply is sent """
+        client, dispatcher = self._connect()
+        client.sendall(b"GET /aaaa HTTP/1.1\r\n\r\n"
+                       b"GET /bbbb HTTP/1.1\r\n\r\n")
+        dispatcher.handle_read()
+        self.assertEqual(self._server.inflight, 2)
+        self._flush(dispatcher)
+        self.assertEqual(self._server.inflight, 0)
+
+    def test_inflight_deferred(self):
+        """ Make sure deferred replies count until they are sent """
+        client, dispatcher = self._connect()
+        client.sendall(b"GET /defer HTTP/1.1\r\n\r\n")
+        dispatcher.handle_read()
+        self._flush(dispatcher)
+        self.assertEqual(self._server.inflight, 1)
+        self._server.deferred[0].write(writer.compose_response_generator(
+            "200", "Ok", {"Transfer-Encoding": "chunked"}, iter(["x"])))
+        self._flush(dispatcher)
+        self.assertEqual(self._server.inflight, 1)
+        dispatcher.write(writer.compose_last_chunk())
+        self._flush(dispatcher)
+        self.assertEqual(self._server.inflight, 0)
+
+    def _get(self, url):
+        """ Send a GET for url on a new connection and read the response """
+        client, dispatcher = self._connect()
+        client.sendall(b"GET " + url + b" HTTP/1.1\r\n\r\n")
+        dispatcher.handle_read()
+        self._flush(dispatcher)
+        client.settimeout(1.0)
+        data = b""
+        while b"\r\n\r\n" not in data:
+            data += client.recv(65536)
+        return data
+
+    def test_shed_max_inflight(self):
+        """ Make sure requests are shed when too many are in flight """
+        self._server = _make_server(max_inflight=1, retry_after=7)
+        client, dispatcher = self._connect()
+        client.sendall(b"GET /defer HTTP/1.1\r\n\r\n")
+        dispatcher.handle_read()
+        response = self._get(b"/aaaa")
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 "))
+        self.assertIn(b"\r\nRetry-After: 7\r\n", response)
+        # Routes with positive priority are never shed
+        self.assertTrue(self._get(b"/health").startswith(b"HTTP/1.1 200 "))
+        self._server.deferred[0].write(writer.compose_response(
+            "200", "Ok", {}, "late"))
+        self._flush(self._server.deferred[0])
+        self.assertTrue(self._get(b"/aaaa").startswith(b"HTTP/1.1 200 "))
+
+    def test_shed_max_loop_lag(self):
+        """ Make sure requests are shed when the loop lags """
+        self._server = _make_server(max_loop_lag=0.01)
+        self._server.note_activity()
+        time.sleep(0.1)
+        self._server.readable()
+        self.assertGreater(self._server.loop_lag, 0.01)
+        self.assertTrue(self._get(b"/aaaa").startswith(b"HTTP/1.1 503 "))
+        self.assertTrue(self._get(b"/health").startswith(b"HTTP/1.1 200 "))
+        while self._server.loop_lag > 0.01:
+            self._server.readable()  # Idle iterations
+        self.assertTrue(self._get(b"/aaaa").startswith(b"HTTP/1.1 200 "))
+
+    def test_subscribers_not_inflight(self):
+        """ Make sure long-lived streams do not count as in flight """
+        self._server = _make_server(max_inflight=2)
+        self._server.add_route("/events", BroadcastHub())
+        for _ in range(3):
+            self._get(b"/events")
+        self.assertEqual(self._server.inflight, 0)
+        self.assertTrue(self._get(b"/aaaa").startswith(b"HTTP/1.1 200 "))
+
+    def test_inflight_closed(self):
+        """ Make sure closing a connection completes its requests """
+        client, dispatcher = self._connect()
+        client.sendall(b"GET /defer HTTP/1.1\r\n\r\n")
+        dispatcher.handle_read()
+        dispatcher.close()
+        self.assertEqual(self._server.inflight, 0)
+
+class ServerTest(unittest.TestCase):
+    """ Tests for Server """
+
+    def setUp(self):
+        self._map = {}
+        self._server = None
+        self._clients = []
+
+    def _listen(self, **kwargs):
+        """ Make the server listen on an ephemeral port """
+        self._server = _make_server(
+            factory=lambda server, sock: RequestDispatcher(server, sock,
+                                                           self._map),
+            **kwargs)
+        self._server.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(16)
+
+    def tearDown(self):
+        for client in self._clients:
+            client.close()
+        for dispatcher in list(self._map.values()):
+            dispatcher.close()
+        self._server.close()
+
+    def _connect(self, count):
+        """ Connect count clients """
+        for _ in range(count):
+            self._clients.append(socket.create_connection(
+                self._server.socket.getsockname()))
+
+    def test_batched_accept_and_sockopts(self):
+        """ Make sure one event accepts many clients and sets options """
+        self._listen()
+        self._server.add_sockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connect(3)
+        self._server.handle_accept()
+        self.assertEqual(len(self._map), 3)
+        for dispatcher in self._map.values():
+            self.assertTrue(dispatcher.socket.getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"),
+                         "accepted sockets inherit TCP_NODELAY on Linux")
+    def test_inherited_sockopts(self):
+        """ Make sure inherited options are not set again """
+        self._listen()
+        self._server.socket.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_NODELAY, 1)
+        self._server.add_sockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connect(1)
+        self._server.handle_accept()
+        self.assertEqual(self._server._sockopts, [])
+        for dispatcher in self._map.values():
+            self.assertTrue(dispatcher.socket.getsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+    def test_max_connections(self):
+        """ Make sure accepting stops at max_connections """
+        self._listen(max_connections=2)
+        self._connect(3)
+        self._server.handle_accept()
+        self.assertEqual(len(self._map), 2)
+        self.assertFalse(self._server.readable())
@@ -0,0 +1,157 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the file_handler module """
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ..file_handler import FileHandler
+from ..messages import Message
+from ..outqueue import OutputQueue
+
+class _Connection(object):
+    """ Connection that records what is written """
+
+    def __init__(self):
+        self.queue = OutputQueue()
+
+    def write(self, data):
+        """ Write data """
+        self.queue.insert_data(data)
+
+    def response(self):
+        """ Return status line, headers and body of the response """
+        pieces = []
+        chunk = self.queue.get_next_chunk()
+        while chunk is not None:
+            pieces.append(chunk.tobytes())
+            chunk = self.queue.get_next_chunk()
+        head, body = b"".join(pieces).split(b"\r\n\r\n", 1)
+        lines = head.decode("iso-8859-1").split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        return lines[0], headers, body
+
+class StaticManifestTest(unittest.TestCase):
+    """ Tests for FileHandler with manifest """
+
+    def setUp(self):
+        self._tmpdir = tempfile.mkdtemp()
+        self._rootdir = os.path.join(self._tmpdir, "www")
+        os.mkdir(self._rootdir)
+        os.mkdir(os.path.join(self._rootdir, "sub"))
+        self._write("index.html", b"root")
+        self._write("sub/index.html", b"sub")
+        with open(os.path.join(self._tmpdir, "secret.txt"), "wb") as filep:
+            filep.write(b"secret")
+        os.symlink(os.path.join(self._tmpdir, "secret.txt"),
+                   os.path.join(self._rootdir, "leak.txt"))
+        self._handlers = []
+
+    def tearDown(self):
+        for handler in self._handlers:
+            handler.close()
+        shutil.rmtree(self._tmpdir)
+
+    def _write(self, name, data):
+        """ Write file below rootdir """
+        with open(os.path.join(self._rootdir, name), "wb") as filep:
+            filep.write(data)
+
+    def _handler(self, **kwargs):
+        """ Make a file handler with manifest """
+        handler = FileHandler(self._rootdir, "index.html", manifest=True,
+                              **kwargs)
+        self._handlers.append(handler)
+        return handler
+
+    @staticmethod
+    def _get(handler, url):
+        """ Process a GET request for url """
+        connection = _Connection()
+        request = Message.request("GET", url, "HTTP/1.1", {})
+        handler().on_end(connection, request)
+        return connection.response()
+
+    def test_serve(self):
+        """ Make sure indexed files and directories are served """
+        handler = self._handler()
+        for url, body in (("/", b"root"), ("/sub", b"sub"),
+                          ("/sub/", b"sub"), ("/index.html", b"root")):
+            first_line, headers, data = self._get(handler, url)
+            self.assertEqual(first_line, "HTTP/1.1 200 Ok")
+            self.assertEqual(headers["content-length"], str(len(body)))
+            self.assertEqual(headers["content-type"], "text/html")
+            self.assertTrue(headers["etag"])
+            self.assertEqual(data, body)
+
+    def test_symlink_escape(self):
+        """ Make sure symlinks escaping rootdir are not served """
+        first_line, _, _ = self._get(self._handler(), "/leak.txt")
+        self.assertEqual(first_line, "HTTP/1.1 403 Forbidden")
+
+    def test_file_swapped_for_symlink(self):
+        """ Make sure a file replaced by an escaping symlink is not served """
+        handler = self._handler()
+        path = os.path.join(self._rootdir, "index.html")
+        os.unlink(path)
+        os.symlink(os.path.join(self._tmpdir, "secret.txt"), path)
+        first_line, _, data = self._get(handler, "/index.html")
+        self.assertEqual(first_line, "HTTP/1.1 403 Forbidden")
+        self.assertNotIn(b"secret", data)
+
+    def test_directory_swapped_for_symlink(self):
+        """ Make sure a directory swapped for a symlink is not served """
+        handler = self._handler()
+        outside = os.path.join(self._tmpdir, "outside")
+        os.mkdir(outside)
+        with open(os.path.join(outside, "index.html"), "wb") as filep:
+            filep.write(b"secret")
+        shutil.rmtree(os.path.join(self._rootdir, "sub"))
+        os.symlink(outside, os.path.join(self._rootdir, "sub"))
+        first_line, _, data = self._get(handler, "/sub/index.html")
+        self.assertEqual(first_line, "HTTP/1.1 403 Forbidden")
+        self.assertNotIn(b"secret", data)
+
+    def test_changed_file(self):
+        """ Make sure validators and size follow file changes """
+        handler = self._handler()
+        _, headers, _ = self._get(handler, "/index.html")
+        self._write("index.html", b"changed content")
+        stat = os.stat(os.path.join(self._rootdir, "index.html"))
+        os.utime(os.path.join(self._rootdir, "index.html"),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+        _, new_headers, data = self._get(handler, "/index.html")
+        self.assertEqual(data, b"changed content")
+        self.assertEqual(new_headers["content-length"], "15")
+        self.assertNotEqual(headers["etag"], new_headers["etag"])
+
+    def test_removed_file(self):
+        """ Make sure removed files are not served """
+        handler = self._handler()
+        os.unlink(os.path.join(self._rootdir, "sub", "index.html"))
+        first_line, _, _ = self._get(handler, "/sub/index.html")
+        self.assertEqual(first_line, "HTTP/1.1 404 Not Found")
+
+    def test_rescan(self):
+        """ Make sure the background rescan indexes new files """
+        handler = self._handler(rescan_interval=0.05)
+        self._write("new.css", b"new")
+        manifest = handler._manifest  # pylint: disable = protected-access
+        deadline = time.monotonic() + 5.0
+        while not manifest.lookup("/new.css"):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        _, headers, data = self._get(handler, "/new.css")
+        self.assertEqual(headers["content-type"], "text/css")
+        self.assertEqual(data, b"new")
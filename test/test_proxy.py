@@ -0,0 +1,217 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the proxy module """
+
+import asyncore
+import http.client
+import socket
+import threading
+import time
+import unittest
+
+from ..core import RequestProcessor, Server
+from ..proxy import ReverseProxy, UpstreamConnection
+from .. import writer
+
+PATHS = ("/echo", "/head", "/peer", "/stream")
+
+def _make_backend():
+    """ Make a backend with routes that exercise the proxy """
+
+    @RequestProcessor
+    def echo(connection, request):
+        """ Reply with the request body """
+        connection.write(writer.compose_response("200", "Ok", {},
+                                                 request.body_as_bytes()))
+
+    @RequestProcessor
+    def head(connection, _):
+        """ Reply to HEAD with a length but without body """
+        connection.write(writer.compose_headers("200", "Ok", {
+            "Content-Length": 5}))
+
+    @RequestProcessor
+    def peer(connection, _):
+        """ Reply with the port of the upstream connection """
+        connection.write(writer.compose_response("200", "Ok", {},
+                                                 str(connection.addr[1])))
+
+    @RequestProcessor
+    def stream(connection, _):
+        """ Reply with a chunked body """
+        connection.write(writer.compose_response_generator(
+            "200", "Ok", {"Transfer-Encoding": "chunked"},
+            iter([b"abc", b"def", b"ghi"]), chunk_size=0))
+        connection.write(writer.compose_last_chunk())
+
+    server = Server()
+    server.add_route("/echo", echo)
+    server.add_route("/head", head)
+    server.add_route("/peer", peer)
+    server.add_route("/stream", stream)
+    return server
+
+def _serve_close_delimited(sock):
+    """ Reply once with an HTTP/1.0 response ended by closing """
+    conn, _ = sock.accept()
+    data = b""
+    while b"\r\n\r\n" not in data:
+        data += conn.recv(65536)
+    conn.sendall(b"HTTP/1.0 200 Ok\r\n\r\nclose delimited")
+    conn.close()
+    sock.close()
+
+def _listen(server):
+    """ Make server listen on an ephemeral port and return the port """
+    server.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+    return server.socket.getsockname()[1]
+
+def _upstreams():
+    """ Return the upstream connections in the socket map """
+    return [dispatcher for dispatcher in list(asyncore.socket_map.values())
+            if isinstance(dispatcher, UpstreamConnection)]
+
+def _unused_port():
+    """ Return a port where nobody is listening """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class ReverseProxyTest(unittest.TestCase):
+    """ Loopback tests for ReverseProxy """
+
+    def setUp(self):
+        self._before = set(asyncore.socket_map)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _start(self, backend):
+        """ Start a proxy to backend and the loop; returns a client """
+        proxy = Server()
+        handler = ReverseProxy([backend])
+        for path in PATHS:
+            proxy.add_route(path, handler)
+        port = _listen(proxy)
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+
+    def _loop(self):
+        """ Run the loop until the test is over """
+        while not self._stop.is_set():
+            asyncore.loop(timeout=0.01, count=1)
+
+    def tearDown(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        for fileno in set(asyncore.socket_map) - self._before:
+            asyncore.socket_map[fileno].close()
+
+    def _start_with_backend(self):
+        """ Start a proxy to a backend of this package """
+        return self._start(("127.0.0.1", _listen(_make_backend())))
+
+    def test_upload_with_length(self):
+        """ Make sure a bounded upload is streamed to backend """
+        client = self._start_with_backend()
+        body = b"A" * 300000
+        client.request("POST", "/echo", body)
+        response = client.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), body)
+        client.close()
+
+    def test_upload_chunked(self):
+        """ Make sure a chunked upload is streamed to backend """
+        client = self._start_with_backend()
+        client.request("POST", "/echo", iter([b"abc"] * 1000),
+                       encode_chunked=True)
+        response = client.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b"abc" * 1000)
+        client.close()
+
+    def test_chunked_response(self):
+        """ Make sure a chunked response is streamed to client """
+        client = self._start_with_backend()
+        client.request("GET", "/stream")
+        response = client.getresponse()
+        self.assertEqual(response.getheader("transfer-encoding"), "chunked")
+        self.assertEqual(response.read(), b"abcdefghi")
+        client.close()
+
+    def test_close_delimited_response(self):
+        """ Make sure a response ended by closing is reframed """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        backend = threading.Thread(target=_serve_close_delimited,
+                                   args=(sock,))
+        backend.start()
+        client = self._start(sock.getsockname())
+        client.request("GET", "/echo")
+        response = client.getresponse()
+        self.assertEqual(response.getheader("transfer-encoding"), "chunked")
+        self.assertEqual(response.read(), b"close delimited")
+        # The client connection survives the upstream one
+        client.request("GET", "/echo")
+        self.assertEqual(client.getresponse().status, 502)
+        client.close()
+        backend.join()
+
+    def test_refused_backend(self):
+        """ Make sure a refused backend yields a 502 """
+        client = self._start(("127.0.0.1", _unused_port()))
+        client.request("GET", "/echo")
+        response = client.getresponse()
+        self.assertEqual(response.status, 502)
+        response.read()
+        client.close()
+
+    def test_pooled_connection_reused(self):
+        """ Make sure keep-alive upstream connections are reused """
+        client = self._start_with_backend()
+        ports = []
+        for _ in range(3):
+            client.request("GET", "/peer")
+            ports.append(client.getresponse().read())
+        self.assertEqual(len(set(ports)), 1)
+        client.close()
+
+    def test_head(self):
+        """ Make sure a HEAD response ends after the headers """
+        client = self._start_with_backend()
+        client.request("HEAD", "/head")
+        response = client.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("content-length"), "5")
+        self.assertEqual(response.read(), b"")
+        # The connections are still usable after the HEAD
+        client.request("GET", "/peer")
+        self.assertEqual(client.getresponse().status, 200)
+        client.close()
+    def test_client_closed_mid_upload(self):
+        """ Make sure the upstream is closed when the client goes away """
+        client = self._start_with_backend()
+        client.connect()
+        client.sock.sendall(b"POST /echo HTTP/1.1\r\n"
+                            b"Content-Length: 1000\r\n\r\n" + b"A" * 10)
+        deadline = time.monotonic() + 5.0
+        while not _upstreams():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        client.close()
+        while _upstreams():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
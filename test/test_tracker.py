@@ -0,0 +1,86 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the tracker module """
+
+import unittest
+
+from ..messages import Message
+from ..tracker import ResponseTracker
+
+class ResponseTrackerTest(unittest.TestCase):
+    """ Tests for ResponseTracker """
+
+    def setUp(self):
+        self._done = []
+        self._tracker = ResponseTracker(
+            lambda entry, status, count: self._done.append((entry, status,
+                                                            count)))
+
+    def _expect(self, method, entry):
+        """ Expect response to a request with method """
+        self._tracker.expect(Message.request(method, "/", "HTTP/1.1", {}),
+                             entry)
+
+    def _feed(self, data, step=None):
+        """ Feed data, optionally in pieces of step bytes """
+        step = step or len(data)
+        for index in range(0, len(data), step):
+            self._tracker.feed(memoryview(data[index:index + step]))
+
+    def test_content_length(self):
+        """ Make sure bounded responses are tracked in any pieces """
+        response = b"HTTP/1.1 200 Ok\r\nContent-Length: 5\r\n\r\nhello"
+        for step in (1, 3, len(response)):
+            self._expect("GET", step)
+            self._feed(response[:-1], step)
+            self.assertEqual(len(self._done), 0)
+            self._feed(response[-1:])
+            self.assertEqual(self._done.pop(), (step, "200", len(response)))
+
+    def test_chunked(self):
+        """ Make sure chunked responses end after the last chunk """
+        response = (b"HTTP/1.1 200 Ok\r\nTransfer-Encoding: chunked\r\n\r\n"
+                    b"5\r\nhello\r\n3;x=y\r\nabc\r\n0\r\nX-T: 1\r\n\r\n")
+        for step in (1, 7, len(response)):
+            self._expect("GET", step)
+            self._feed(response[:-1], step)
+            self.assertEqual(len(self._done), 0)
+            self._feed(response[-1:])
+            self.assertEqual(self._done.pop(), (step, "200", len(response)))
+
+    def test_pipelined(self):
+        """ Make sure pipelined responses are completed in order """
+        self._expect("GET", "a")
+        self._expect("GET", "b")
+        self._feed(b"HTTP/1.1 200 Ok\r\nContent-Length: 2\r\n\r\nok"
+                   b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+        self.assertEqual([entry[:2] for entry in self._done],
+                         [("a", "200"), ("b", "404")])
+
+    def test_interim_head_and_no_body(self):
+        """ Make sure 1xx, HEAD, 204 and 304 are handled """
+        self._expect("POST", "post")
+        self._expect("HEAD", "head")
+        self._expect("GET", "nocontent")
+        self._feed(b"HTTP/1.1 100 Continue\r\nContent-Length: 0\r\n\r\n")
+        self.assertEqual(self._done, [])
+        self._feed(b"HTTP/1.1 200 Ok\r\nContent-Length: 0\r\n\r\n"
+                   b"HTTP/1.1 200 Ok\r\nContent-Length: 10\r\n\r\n"
+                   b"HTTP/1.1 204 No Content\r\n\r\n")
+        self.assertEqual([entry[:2] for entry in self._done],
+                         [("post", "200"), ("head", "200"),
+                          ("nocontent", "204")])
+
+    def test_close(self):
+        """ Make sure pending responses are completed on close """
+        self._expect("GET", "a")
+        self._expect("GET", "b")
+        self._feed(b"HTTP/1.1 200 Ok\r\n\r\nuntil close")
+        self.assertEqual(self._done, [])
+        self._tracker.close()
+        self.assertEqual(self._done, [("a", "200", 30), ("b", "", 0)])
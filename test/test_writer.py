@@ -0,0 +1,60 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Tests for the writer module """
+
+import unittest
+
+from ..outqueue import OutputQueue
+from .. import writer
+
+def _serialize(data):
+    """ Serialize what writer composed into bytes """
+    queue = OutputQueue()
+    queue.insert_data(data)
+    pieces = []
+    chunk = queue.get_next_chunk()
+    while chunk is not None:
+        pieces.append(chunk.tobytes())
+        chunk = queue.get_next_chunk()
+    return b"".join(pieces)
+
+def _compose(generator, **kwargs):
+    """ Compose chunked response body from generator """
+    data = _serialize(writer.compose_response_generator("200", "Ok", {
+        "Transfer-Encoding": "chunked",
+    }, generator, **kwargs))
+    return data.split(b"\r\n\r\n", 1)[1]
+
+class ComposeResponseGeneratorTest(unittest.TestCase):
+    """ Tests for compose_response_generator() """
+
+    def test_coalesce(self):
+        """ Make sure small pieces are coalesced into one chunk """
+        body = _compose(("row,%d\n" % num for num in range(3)))
+        self.assertEqual(body, b"12\r\nrow,0\nrow,1\nrow,2\n\r\n")
+
+    def test_flush(self):
+        """ Make sure FLUSH sends what is buffered """
+        body = _compose(iter(["a", writer.FLUSH, "b"]))
+        self.assertEqual(body, b"1\r\na\r\n1\r\nb\r\n")
+
+    def test_large_piece(self):
+        """ Make sure large pieces are sent on their own """
+        body = _compose(iter(["a", b"b" * 16]), chunk_size=8)
+        self.assertEqual(body, b"1\r\na\r\n10\r\n" + b"b" * 16 + b"\r\n")
+
+    def test_bytes_like(self):
+        """ Make sure bytearray and memoryview pieces work """
+        body = _compose(iter([bytearray(b"a"), memoryview(b"b"), "c"]))
+        self.assertEqual(body, b"3\r\nabc\r\n")
+
+    def test_no_coalescing(self):
+        """ Make sure chunk_size=0 frames each piece and ignores FLUSH """
+        body = _compose(iter([b"a", writer.FLUSH, bytearray(b"b")]),
+                        chunk_size=0)
+        self.assertEqual(body, b"1\r\na\r\n1\r\nb\r\n")
@@ -0,0 +1,130 @@
+#
+# This file is part of Neubot <https://www.neubot.org/>.
+#
+# Neubot is free software. See AUTHORS and LICENSE for more
+# information on the copying conditions.
+#
+
+""" Track the end of responses sent on a connection """
+
+import collections
+import logging
+
+class ResponseTracker(object):
+    """
+     Follows the framing of the responses sent on a connection to tell
+     when each of them has been completely sent.
+
+     Call expect() for each request, in order, and feed() with the bytes
+     actually sent. When a response is complete, callback is invoked with
+     the object passed to expect(), the response status and the number
+     of bytes sent for it (including interim "1xx" responses). Body bytes
+     are only counted, never copied.
+    """
+
+    def __init__(self, callback, maxhead=65536):
+        self._buffer = b""
+        self._callback = callback
+        self._count = 0
+        self._maxhead = maxhead
+        self._pending = collections.deque()
+        self._remaining = 0
+        self._state = "head"
+        self._status = ""
+
+    def expect(self, request, entry):
+        """ Expect the response to request; entry is passed to callback """
+        self._pending.append((request.method, entry))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _scan(self, view, terminator):
+        """ Accumulate bytes until terminator; returns (consumed, data) """
+        prefix = view[:self._maxhead].tobytes()
+        data = self._buffer + prefix
+        pos = data.find(terminator, max(0, len(self._buffer) -
+                                        len(terminator) + 1))
+        if pos < 0:
+            if len(data) > self._maxhead:
+                raise ValueError("response head too long")
+            self._buffer = data
+            return len(prefix), None
+        end = pos + len(terminator)
+        consumed = end - len(self._buffer)
+        self._buffer = b""
+        return consumed, data[:end]
+
+    def _on_head(self, data):
+        """ Process the head of a response """
+        lines = data.decode("iso-8859-1").split("\r\n")
+        self._status = lines[0].split(None, 2)[1]
+        if self._status[:1] == "1":
+            return  # Interim response, wait for the final one
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+        method = self._pending[0][0] if self._pending else ""
+        if method == "HEAD" or self._status in ("204", "304"):
+            self._done()
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            self._state = "size"
+        elif "content-length" in headers:
+            self._remaining = int(headers["content-length"])
+            self._state = "body"
+            if not self._remaining:
+                self._done()
+        else:
+            self._state = "close"  # Ends when the connection is closed
+
+    def _done(self):
+        """ Called when the current response is complete """
+        status, count = self._status, self._count
+        self._state, self._status, self._count = "head", "", 0
+        if self._pending:
+            self._callback(self._pending.popleft()[1], status, count)
+
+    def feed(self, view):
+        """ Account for the bytes in view, which have been sent """
+        while view:
+            if self._state in ("body", "data", "close", "unknown"):
+                if self._state in ("close", "unknown"):
+                    consumed = len(view)
+                else:
+                    consumed = min(len(view), self._remaining)
+                    self._remaining -= consumed
+                self._count += consumed
+                view = view[consumed:]
+                if self._state == "body" and not self._remaining:
+                    self._done()
+                elif self._state == "data" and not self._remaining:
+                    self._state = "size"
+                continue
+            try:
+                consumed, data = self._scan(view, b"\r\n\r\n"
+                                            if self._state == "head"
+                                            else b"\r\n")
+                self._count += consumed
+                view = view[consumed:]
+                if data is None:
+                    continue
+                if self._state == "head":
+                    self._on_head(data)
+                elif self._state == "size":
+                    size = int(data.split(b";", 1)[0].strip(), 16)
+                    if size:
+                        self._remaining, self._state = size + 2, "data"
+                    else:
+                        self._state = "trailer"
+                elif data == b"\r\n":
+                    self._done()  # End of trailer
+            except (IndexError, ValueError):
+                logging.warning("http: cannot follow response framing")
+                self._buffer, self._state = b"", "unknown"
+
+    def close(self):
+        """ Complete the pending responses when the connection closes """
+        while self._pending:
+            self._done()
@@ -9,6 +9,51 @@
 
 import logging
 import os
+import time
+
+FLUSH = object()
+
+def _coalesce(generator, chunk_size, flush_interval):
+    """
+     Merge the small pieces yielded by generator into larger pieces.
+
+     Pieces are buffered until at least chunk_size bytes are available,
+     or until the generator yields FLUSH. The flush_interval is checked
+     only when the generator yields the next piece, so it is not a
+     deadline: buffered pieces wait for the generator to yield again
+     even when flush_interval has passed. Generators that may block for
+     long should yield FLUSH. Pieces of at least chunk_size bytes are
+     passed through without copying them, so the buffer never holds
+     more than 2 * chunk_size bytes.
+    """
+    buffered, count, started = [], 0, 0.0
+    for part in generator:
+        if part is FLUSH:
+            if buffered:
+                yield b"".join(buffered)
+                buffered, count = [], 0
+            continue
+        if not part:
+            continue
+        if isinstance(part, str):
+            part = part.encode("iso-8859-1")
+        if buffered and len(part) >= chunk_size:
+            yield b"".join(buffered)
+            buffered, count = [], 0
+        if len(part) >= chunk_size:
+            yield part
+            continue
+        if not buffered and flush_interval is not None:
+            started = time.monotonic()
+        buffered.append(part)
+        count += len(part)
+        if count >= chunk_size or (flush_interval is not None and
+                                   time.monotonic() - started >=
+                                   flush_interval):
+            yield b"".join(buffered)
+            buffered, count = [], 0
+    if buffered:
+        yield b"".join(buffered)
 
 def _compose(first_line, headers, bounded_body, filep, generator, size):
     """ Compose a generic HTTP message """
@@ -18,7 +63,7 @@ def _compose(first_line, headers, bounded_body, filep, generator, size):
 
     ischunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
 
-    if not ischunked:
+    if not ischunked and headers.get("Content-Length") is None:
         tot = 0
         if bounded_body:
             tot += len(bounded_body)
@@ -67,8 +112,23 @@ def compose_response_filep(code, reason, headers, filep, size=65536):
     return _compose("HTTP/1.1 %s %s" % (code, reason),
                     headers, None, filep, None, size)
 
-def compose_response_generator(code, reason, headers, generator):
-    """ Compose an HTTP response reading body from generator """
+def compose_response_generator(code, reason, headers, generator,
+                               chunk_size=8192, flush_interval=0.1):
+    """
+     Compose an HTTP response reading body from generator.
+
+     When the body is chunked, small pieces yielded by generator are
+     coalesced into chunks of about chunk_size bytes (see _coalesce()).
+     Buffered pieces are also framed when a piece arrives flush_interval
+     seconds or more after the first one, but there is no timer. Yield
+     FLUSH to send what is buffered immediately, or pass a zero
+     chunk_size to frame each piece on its own. The buffer is capped at
+     2 * chunk_size bytes.
+    """
+    if chunk_size > 0:
+        generator = _coalesce(generator, chunk_size, flush_interval)
+    else:
+        generator = (part for part in generator if part is not FLUSH)
     return _compose("HTTP/1.1 %s %s" % (code, reason),
                     headers, None, None, generator, 0)
 